@@ -0,0 +1,61 @@
+"""
+SMARTWORTH - startup benchmark
+
+Starts a fresh interpreter several times and measures:
+  import      -> "import smartworth" only (what tests and the menu pay)
+  first read  -> import + first database read (schema is created here)
+  sqlalchemy  -> "import sqlalchemy" alone, the floor for any database access
+  scraper     -> import + loading the scraping libraries
+
+Usage: python bench_startup.py [runs]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    "import": "import smartworth",
+    "first read": "import smartworth; smartworth.Database().get_history('bench')",
+    "sqlalchemy": "import sqlalchemy",
+    "scraper": "import smartworth, requests, bs4",
+}
+
+TIMER = (
+    "import sys, time; sys.path.insert(0, {here!r}); t = time.perf_counter(); "
+    "{code}; print(time.perf_counter() - t)"
+)
+
+
+def run_once(code: str, workdir: str) -> float:
+    script = TIMER.format(here=HERE, code=code)
+    out = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print(f"SMARTWORTH startup benchmark ({runs} runs each)\n")
+    with tempfile.TemporaryDirectory() as workdir:
+        for label, code in SCENARIOS.items():
+            times = [run_once(code, workdir) * 1000 for _ in range(runs)]
+            print(
+                f"{label:<11}: median {statistics.median(times):7.1f} ms | "
+                f"min {min(times):7.1f} ms | max {max(times):7.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
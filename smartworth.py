@@ -11,86 +11,893 @@ The code is kept simple enough for a student-level implementation.
 # IMPORTS
 
 
-import requests
-from bs4 import BeautifulSoup
-import subprocess
+# Only the standard library is imported here. requests, bs4 and SQLAlchemy
+# are imported inside the functions that need them, so the menu (and any
+# test that imports this module) does not pay for them up front.
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
-from sqlalchemy import (
-    create_engine, MetaData, Table,
-    Column, Integer, String, Float, Text
-)
-from sqlalchemy.sql import select, insert, delete
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict, is_dataclass
+
+
+# METRICS
+#
+# In-process counters and latency histograms for the hot paths (scraping,
+# parsing, scoring, database calls). Dump them with --metrics-out FILE,
+# or GET /metrics when running the API server.
+
+
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (seconds), Prometheus style."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        from bisect import bisect_left
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-th observation. Like
+        Prometheus' histogram_quantile, ranks in the +Inf bucket report the
+        largest finite bound (see max for the real worst case), so the
+        value is always valid JSON.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Process-wide registry of labelled counters and histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Times the block into histogram `name`; errors are counted too."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.incr(name.replace("_seconds", "") + "_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator form of timer()."""
+        import functools
+
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+
+        return decorate
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> dict:
+        """Plain-dict copy of every metric, suitable for JSON."""
+        with self.lock:
+            counters = [
+                {"name": n, "labels": dict(l), "value": v}
+                for (n, l), v in sorted(self.counters.items())
+            ]
+            histograms = [
+                {
+                    "name": n,
+                    "labels": dict(l),
+                    "count": h.count,
+                    "sum": round(h.sum, 6),
+                    "max": round(h.max, 6),
+                    "p50": h.quantile(0.5),
+                    "p90": h.quantile(0.9),
+                    "p99": h.quantile(0.99),
+                    "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts)),
+                }
+                for (n, l), h in sorted(self.histograms.items())
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format."""
+
+        def fmt_labels(labels, extra=None):
+            items = list(labels) + ([extra] if extra else [])
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                full = f"smartworth_{name}"
+                if full not in typed:
+                    lines.append(f"# TYPE {full} counter")
+                    typed.add(full)
+                lines.append(f"{full}{fmt_labels(labels)} {value}")
+
+            for (name, labels), h in sorted(self.histograms.items()):
+                full = f"smartworth_{name}"
+                if full not in typed:
+                    lines.append(f"# TYPE {full} histogram")
+                    typed.add(full)
+                cumulative = 0
+                for bound, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += n
+                    le = fmt_labels(labels, ("le", bound))
+                    lines.append(f"{full}_bucket{le} {cumulative}")
+                lines.append(f"{full}_sum{fmt_labels(labels)} {h.sum:.6f}")
+                lines.append(f"{full}_count{fmt_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Writes a .json snapshot or, for any other name, Prometheus text."""
+        if path.endswith(".json"):
+            data = json.dumps(self.snapshot(), indent=2, allow_nan=False)
+        else:
+            data = self.to_prometheus()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(data)
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def profiling(path: str = ""):
+    """
+    Runs the block under cProfile when path is set, then saves the stats
+    to path (open with pstats / snakeviz) and prints the top entries.
+    """
+    if not path:
+        yield
+        return
+
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(25)
+
+
+# STORAGE BACKEND
+
+
+@dataclass
+class StorageProfile:
+    """Pool settings, plus the pragmas used when the backend is SQLite."""
+    name: str
+    journal_mode: str
+    synchronous: str
+    cache_size: int      # negative value = size in KiB
+    mmap_size: int       # bytes, 0 disables memory mapping
+    busy_timeout: int    # milliseconds to wait on a locked database
+    auto_vacuum: str     # NONE | INCREMENTAL (only applies to new files)
+    pool_size: int
+    max_overflow: int
+    writer_thread: bool  # serialize all writes through one background thread
+
+
+STORAGE_PROFILES = {
+    # Plain SQLite defaults, writes happen on the caller's thread.
+    "simple": StorageProfile(
+        name="simple",
+        journal_mode="DELETE",
+        synchronous="FULL",
+        cache_size=-2000,
+        mmap_size=0,
+        busy_timeout=5000,
+        auto_vacuum="NONE",
+        pool_size=5,
+        max_overflow=10,
+        writer_thread=False,
+    ),
+    # WAL: many readers keep working while a single writer ingests.
+    "concurrent": StorageProfile(
+        name="concurrent",
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-64000,
+        mmap_size=256 * 1024 * 1024,
+        busy_timeout=30000,
+        auto_vacuum="INCREMENTAL",
+        pool_size=10,
+        max_overflow=20,
+        writer_thread=True,
+    ),
+}
+
+DEFAULT_STORAGE_PROFILE = "concurrent"
+
+
+def load_storage_profile() -> StorageProfile:
+    """Picks the profile named by SMARTWORTH_STORAGE_PROFILE."""
+    name = os.environ.get("SMARTWORTH_STORAGE_PROFILE", DEFAULT_STORAGE_PROFILE)
+    name = name.strip().lower()
+    if name not in STORAGE_PROFILES:
+        print(
+            f"Unknown storage profile '{name}', using '{DEFAULT_STORAGE_PROFILE}'.",
+            file=sys.stderr,
+        )
+        name = DEFAULT_STORAGE_PROFILE
+    return STORAGE_PROFILES[name]
+
+
+def load_db_url(default: str) -> str:
+    """
+    Database URL from SMARTWORTH_DB_URL, then "db_url" in smartworth.json,
+    then the local SQLite file.
+    """
+    url = os.environ.get("SMARTWORTH_DB_URL", "").strip()
+    if url:
+        return url
+
+    config_path = os.environ.get("SMARTWORTH_CONFIG", "smartworth.json")
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            url = str(json.load(f).get("db_url", "")).strip()
+    except (OSError, ValueError, AttributeError):
+        url = ""
+
+    return url or default
+
+
+def create_storage_engine(url: str, profile: StorageProfile):
+    """Creates a pooled engine for the URL; SQLite also gets the pragmas."""
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.engine import make_url
+    from sqlalchemy.pool import QueuePool
+
+    if make_url(url).get_backend_name() != "sqlite":
+        return create_engine(
+            url,
+            echo=False,
+            future=True,
+            pool_size=profile.pool_size,
+            max_overflow=profile.max_overflow,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+        )
+
+    new_engine = create_engine(
+        url,
+        echo=False,
+        future=True,
+        poolclass=QueuePool,
+        pool_size=profile.pool_size,
+        max_overflow=profile.max_overflow,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": profile.busy_timeout / 1000,
+        },
+    )
+
+    @event.listens_for(new_engine, "connect")
+    def apply_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        # auto_vacuum only takes effect before the first table exists, and
+        # setting it on an existing file waits for the write lock, so it is
+        # only sent to brand-new (empty) files.
+        cur.execute("PRAGMA page_count")
+        if cur.fetchone()[0] == 0:
+            cur.execute(f"PRAGMA auto_vacuum={profile.auto_vacuum}")
+        cur.execute(f"PRAGMA journal_mode={profile.journal_mode}")
+        cur.execute(f"PRAGMA synchronous={profile.synchronous}")
+        cur.execute(f"PRAGMA cache_size={int(profile.cache_size)}")
+        cur.execute(f"PRAGMA mmap_size={int(profile.mmap_size)}")
+        cur.execute(f"PRAGMA busy_timeout={int(profile.busy_timeout)}")
+        cur.close()
+
+    return new_engine
+
+
+class DatabaseWriter:
+    """
+    Background thread that runs every write job one after another.
+    Readers use the pool directly, so they never wait behind this queue.
+    """
+
+    def __init__(self, db_engine):
+        self.engine = db_engine
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(
+            target=self._run, name="smartworth-writer", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, job) -> Future:
+        """Queues job(conn); the returned future holds its result."""
+        future = Future()
+        self.jobs.put((job, future, time.perf_counter()))
+        return future
+
+    def run(self, job):
+        """Queues job(conn) and waits until it is committed."""
+        return self.submit(job).result()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+
+            job, future, queued_at = item
+            metrics.observe("db_writer_wait_seconds", time.perf_counter() - queued_at)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.engine.begin() as conn:
+                    result = job(conn)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
 
 
 # DATABASE INITIALIZATION
 
 
 DB_NAME = "smartworth.db"
-engine = create_engine(f"sqlite:///{DB_NAME}", echo=False, future=True)
-metadata = MetaData()
-
-# USERS TABLE
-users_table = Table(
-   "users",
-   metadata,
-   Column("id", Integer, primary_key=True),
-   Column("username", String, unique=True),
-   Column("password_hash", String),
-   Column("role", String),
-)
+# Stored in PRAGMA user_version once an SQLite file has every table and
+# migration below; bump it whenever define_tables or the migration changes.
+SQLITE_SCHEMA_VERSION = 2
+HISTORY_PARTITIONS = int(os.environ.get("SMARTWORTH_HISTORY_PARTITIONS", "8"))
+
+
+def define_tables(metadata) -> dict:
+    """Declares every table on metadata and returns them by short name."""
+    from sqlalchemy import Table, Column, Integer, String, Float, Text
+
+    # USERS TABLE
+    users = Table(
+       "users",
+       metadata,
+       Column("id", Integer, primary_key=True),
+       Column("username", String, unique=True),
+       Column("password_hash", String),
+       Column("role", String),
+    )
 
-# PRODUCTS TABLE
-products_table = Table(
-    "products",
-     metadata,
-     Column("id", Integer, primary_key=True),
-     Column("user_id", Integer, primary_key=True),
-     Column("name", String),
-     Column("category", String),
-     Column("avg_price", Float),
-     Column("min_price", Float),
-     Column("max_price", Float),
-     Column("price_spread", Float),
-     Column("value_score", Integer),
-     Column("trend", String),
-     Column("description", Text),
-     Column("supply_level", String),
-     Column("consistency", Float),
-     Column("date_added", String),
-)
+    # PRODUCTS TABLE
+    products = Table(
+        "products",
+         metadata,
+         Column("id", Integer, primary_key=True),
+         Column("user_id", Integer, index=True),
+         Column("name", String),
+         Column("category", String),
+         Column("avg_price", Float),
+         Column("min_price", Float),
+         Column("max_price", Float),
+         Column("price_spread", Float),
+         Column("value_score", Integer),
+         Column("trend", String),
+         Column("description", Text),
+         Column("supply_level", String),
+         Column("consistency", Float),
+         Column("date_added", String),
+    )
 
-# HISTORY TABLE
-history_table = Table(
-    "history",
-    metadata,
-    Column("id", Integer, primary_key=True),
-    Column("product_name", String),
-    Column("price", Float),
-    Column("source", String),
-    Column("date", String),
-)
+    # HISTORY TABLE
+    history = Table(
+        "history",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("product_name", String),
+        Column("price", Float),
+        Column("source", String),
+        Column("date", String),
+    )
+
+    # ALERT RULES TABLE
+    alerts = Table(
+        "alert_rules",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer, index=True),
+        Column("product_name", String, index=True),
+        Column("kind", String),          # below | drop | new_low
+        Column("threshold", Float),      # trigger price for below / drop
+        Column("percent", Float),
+        Column("baseline", Float),
+        Column("active", Integer),
+        Column("created", String),
+        Column("triggered_at", String),
+    )
+
+    # LOWEST STORED PRICE per product with new_low rules (see PRICE ALERTS)
+    lows = Table(
+        "price_lows",
+        metadata,
+        Column("product_name", String, primary_key=True),
+        Column("low", Float),
+        Column("updated", String),
+    )
+
+    # HISTORY ROLLUP TABLES (see HISTORY RETENTION)
+    rollups = {
+        tier: Table(
+            f"history_{tier}",
+            metadata,
+            Column("id", Integer, primary_key=True),
+            Column("product_name", String, index=True),
+            Column("source", String),
+            Column("bucket_start", String, index=True),  # "%Y-%m-%d %H:%M"
+            Column("min_price", Float),
+            Column("avg_price", Float),
+            Column("max_price", Float),
+            Column("count", Integer),
+        )
+        for tier in ("hourly", "daily", "weekly")
+    }
+
+    # API TOKENS TABLE (only hashes are stored)
+    tokens = Table(
+        "api_tokens",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer, index=True),
+        Column("token_hash", String, unique=True),
+        Column("created", String),
+    )
+
+    return {
+        "users": users,
+        "products": products,
+        "history": history,
+        "tokens": tokens,
+        "alerts": alerts,
+        "lows": lows,
+        "rollups": rollups,
+    }
+
+
+def create_history_partitions(conn, partitions: int) -> None:
+    """
+    PostgreSQL only: history is hash-partitioned on product_name so that
+    lookups and inserts for one product touch a single partition.
+    """
+    from sqlalchemy import text
+
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS history ("
+        " id BIGSERIAL,"
+        " product_name VARCHAR,"
+        " price DOUBLE PRECISION,"
+        " source VARCHAR,"
+        " date VARCHAR,"
+        " PRIMARY KEY (id, product_name)"
+        ") PARTITION BY HASH (product_name)"
+    ))
+    for i in range(partitions):
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS history_p{i} PARTITION OF history "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i})"
+        ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS history_product_name_idx "
+        "ON history (product_name, id)"
+    ))
+
+
+def migrate_sqlite_schema(storage) -> None:
+    """
+    Brings SQLite files made by older versions up to date:
+    products used a composite (id, user_id) key that never generated ids,
+    and history had no index for per-product lookups.
+    """
+    from sqlalchemy import inspect, text
+
+    inspector = inspect(storage.engine)
+    if "products" in inspector.get_table_names():
+        pk = inspector.get_pk_constraint("products")["constrained_columns"]
+        if pk != ["id"]:
+            cols = ", ".join(c.name for c in storage.products.columns)
+            with storage.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE products RENAME TO products_old"))
+                storage.products.create(conn)
+                conn.execute(text(
+                    f"INSERT INTO products ({cols}) SELECT {cols} FROM products_old"
+                ))
+                conn.execute(text("DROP TABLE products_old"))
+
+    with storage.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_history_product_name "
+            "ON history (product_name, id)"
+        ))
+
+
+def create_schema(storage) -> None:
+    """Creates missing tables using the backend-specific layout."""
+    if storage.engine.dialect.name == "postgresql":
+        with storage.engine.begin() as conn:
+            create_history_partitions(conn, HISTORY_PARTITIONS)
+        others = [
+            t for t in storage.metadata.sorted_tables if t is not storage.history
+        ]
+        storage.metadata.create_all(storage.engine, tables=others)
+        return
+
+    if storage.engine.dialect.name != "sqlite":
+        storage.metadata.create_all(storage.engine)
+        return
+
+    # Up-to-date files skip the table checks and the migration entirely.
+    with storage.engine.connect() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+    if version >= SQLITE_SCHEMA_VERSION:
+        return
+
+    storage.metadata.create_all(storage.engine)
+    migrate_sqlite_schema(storage)
+    with storage.engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
+
+
+class Storage:
+    """Engine, tables and writer thread; built on the first database access."""
+
+    def __init__(self, url: str, profile: StorageProfile):
+        from sqlalchemy import MetaData
+
+        self.url = url
+        self.profile = profile
+        self.engine = create_storage_engine(url, profile)
+        self.metadata = MetaData()
+        tables = define_tables(self.metadata)
+        self.users = tables["users"]
+        self.products = tables["products"]
+        self.history = tables["history"]
+        self.tokens = tables["tokens"]
+        self.alerts = tables["alerts"]
+        self.lows = tables["lows"]
+        self.rollups = tables["rollups"]
+
+        # Only SQLite needs writes funnelled through one thread; PostgreSQL
+        # handles concurrent writers itself.
+        self.writer = (
+            DatabaseWriter(self.engine)
+            if profile.writer_thread and self.engine.dialect.name == "sqlite"
+            else None
+        )
+        create_schema(self)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Storage:
+    """Returns the shared Storage, creating engine and schema on first use."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = Storage(
+                    load_db_url(f"sqlite:///{DB_NAME}"), load_storage_profile()
+                )
+    return _storage
 
-metadata.create_all(engine)
+
+# Older code imported these names directly from the module.
+_STORAGE_ALIASES = {
+    "engine": "engine",
+    "metadata": "metadata",
+    "writer": "writer",
+    "storage_profile": "profile",
+    "DB_URL": "url",
+    "users_table": "users",
+    "products_table": "products",
+    "history_table": "history",
+}
+
+
+def __getattr__(name):
+    if name in _STORAGE_ALIASES:
+        return getattr(get_storage(), _STORAGE_ALIASES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def run_write(job):
+    """Runs job(conn) in a write transaction, through the writer if enabled."""
+    storage = get_storage()
+    if storage.writer is not None:
+        return storage.writer.run(job)
+    with storage.engine.begin() as conn:
+        return job(conn)
 
 
 #LOGGING
+#
+# write_log() only puts a record on a queue; a background thread formats
+# the records as JSON lines, writes them in batches and rotates the file.
+# Settings: SMARTWORTH_LOG_FILE, SMARTWORTH_LOG_LEVEL, SMARTWORTH_LOG_MAX_BYTES,
+# SMARTWORTH_LOG_BACKUPS, SMARTWORTH_LOG_ROTATE_SECONDS.
+# Several processes may append to the same file; before each batch a
+# logger checks whether another one rotated it and reopens if so.
+
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+
+class BackgroundLogger:
+    """Non-blocking structured logger with batched writes and rotation."""
+
+    def __init__(
+        self,
+        path="smartworth_logs.jsonl",
+        level="INFO",
+        max_bytes=5 * 1024 * 1024,
+        backup_count=5,
+        rotate_seconds=24 * 3600,
+        batch_size=500,
+        flush_interval=1.0,
+        queue_size=100_000,
+    ):
+        self.path = path
+        self.level = LOG_LEVELS.get(level.upper(), 20)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_seconds = rotate_seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = queue.Queue(maxsize=queue_size)
+        self.file = None
+        self.opened_at = 0.0
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def log(self, level: str, message: str, /, **fields) -> None:
+        """Queues one record; drops it (and counts) if the queue is full."""
+        level = level.upper()
+        if LOG_LEVELS.get(level, 20) < self.level:
+            return
+        if self.thread is None:
+            self._start()
+
+        # Caller fields live under "fields", so they can never replace
+        # ts / level / msg.
+        record = {"ts": time.time(), "level": level, "msg": message}
+        if fields:
+            record["fields"] = fields
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            metrics.incr("log_dropped_total")
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Waits (up to timeout) until everything queued so far is on disk."""
+        deadline = time.monotonic() + timeout
+        while (
+            self.thread is not None and self.thread.is_alive()
+            and self.records.unfinished_tasks
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.01)
+
+    def close(self, timeout: float = 5.0) -> None:
+        thread = self.thread
+        if thread is None:
+            return
+        try:
+            self.records.put(None, timeout=timeout)
+        except queue.Full:
+            metrics.incr("log_dropped_total")
+        thread.join(timeout)
+        self.thread = None
+
+    def _start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="smartworth-logger", daemon=True
+                )
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                first = self.records.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            try:
+                self._write([r for r in batch if r is not None])
+            except Exception:
+                metrics.incr("log_write_errors_total")
+            finally:
+                for _ in batch:
+                    self.records.task_done()
+            if stop:
+                if self.file:
+                    self.file.close()
+                    self.file = None
+                return
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        lines = []
+        for r in batch:
+            try:
+                r["ts"] = datetime.fromtimestamp(r["ts"]).isoformat(timespec="milliseconds")
+                lines.append(json.dumps(r, ensure_ascii=False, default=str))
+            except Exception:
+                # A record that cannot be formatted is skipped, not fatal.
+                metrics.incr("log_format_errors_total")
+        if not lines:
+            return
+        try:
+            if self.file is None:
+                self._open()
+            elif self._replaced():
+                self._open()  # another process rotated the shared file
+            elif self._should_rotate():
+                self._rotate()
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+        except Exception:
+            metrics.incr("log_write_errors_total")
+
+    def _open(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def _replaced(self) -> bool:
+        """
+        True when self.path is no longer the file we hold open. CLI runs,
+        trackers and the server all log to the same file by default, so
+        any of them may have rotated it.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        own = os.fstat(self.file.fileno())
+        return (st.st_dev, st.st_ino) != (own.st_dev, own.st_ino)
 
+    def _should_rotate(self) -> bool:
+        # Size of the shared file, including other processes' appends.
+        size = os.fstat(self.file.fileno()).st_size
+        if self.max_bytes and size >= self.max_bytes:
+            return True
+        return bool(
+            self.rotate_seconds and size
+            and time.time() - self.opened_at >= self.rotate_seconds
+        )
+
+    def _rotate(self):
+        """smartworth_logs.jsonl -> .1 -> .2 ...; the oldest one is deleted."""
+        if self._replaced():
+            self._open()  # lost the race: someone else just rotated
+            return
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+
+_logger = None
+
+
+def get_logger() -> BackgroundLogger:
+    """Shared logger, configured from the environment on first use."""
+    global _logger
+    if _logger is None:
+        import atexit
+
+        env = os.environ.get
+        _logger = BackgroundLogger(
+            path=env("SMARTWORTH_LOG_FILE", "smartworth_logs.jsonl"),
+            level=env("SMARTWORTH_LOG_LEVEL", "INFO"),
+            max_bytes=int(env("SMARTWORTH_LOG_MAX_BYTES", str(5 * 1024 * 1024))),
+            backup_count=int(env("SMARTWORTH_LOG_BACKUPS", "5")),
+            rotate_seconds=float(env("SMARTWORTH_LOG_ROTATE_SECONDS", str(24 * 3600))),
+        )
+        atexit.register(_logger.close)
+    return _logger
 
-def write_log(message: str) -> None:
-    """Simple log writer."""
-    try:
-        with open("smartworth_logs.txt", "a", encoding="utf-8") as f:
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            f.write(f"[{now}] {message}\n")
-    except Exception:
-        pass
+
+def write_log(message: str, /, level: str = "INFO", **fields) -> None:
+    """Logs one structured event without waiting for disk I/O."""
+    get_logger().log(level, message, **fields)
 
 
 # UTILITY FUNCTIONS
 
 
+@metrics.timed("price_normalize_seconds")
 def normalize_price_text(text: str) -> float:
     """
     Converts different currency formats to float TL.
@@ -114,9 +921,19 @@ def normalize_price_text(text: str) -> float:
             return float(t.replace("usd", "").replace("$", "")) * 35
         return float(t)
     except Exception:
+        metrics.incr("price_normalize_rejects_total")
         return 0.0
 
 
+CURRENCY_MARKERS = ("tl", "₺", "try", "$", "usd")
+
+
+def looks_like_price(text: str) -> bool:
+    """True when the text has a digit and a currency marker."""
+    t = text.lower()
+    return any(ch.isdigit() for ch in t) and any(m in t for m in CURRENCY_MARKERS)
+
+
 def simple_hash(text: str) -> str:
     """Very simple password hashing."""
     total = 0
@@ -131,38 +948,48 @@ def simple_hash(text: str) -> str:
 class UserAuth:
     """Handles user registration and login."""
 
-    def __init__(self):
-        self.engine = engine
+    @property
+    def engine(self):
+        return get_storage().engine
 
+    @metrics.timed("auth_seconds", method="register")
     def register(self, username: str, password: str, role="user"):
         if not username or not password:
             print("Username and password cannot be empty.")
             return False
 
+        from sqlalchemy import insert
+
         pw = simple_hash(password)
+        users_table = get_storage().users
 
         try:
-            with self.engine.begin() as conn:
-                conn.execute(
+            run_write(
+                lambda conn: conn.execute(
                     insert(users_table).values(
                         username=username,
                         password_hash=pw,
                         role=role,
                     )
                 )
-            write_log(f"User registered: {username}")
+            )
+            write_log("User registered", username=username)
             return True
         except Exception as e:
-            write_log(f"Registration failed: {e}")
+            write_log("Registration failed", "WARNING", username=username, error=str(e))
             print("This username may already exist.")
             return False
 
-    def login(self, username: str, password: str):
+    @metrics.timed("auth_seconds", method="check_credentials")
+    def check_credentials(self, username: str, password: str):
+        """Same check as login() but silent; returns (user_id, role)."""
         if not username or not password:
-            print("Empty login is not allowed.")
             return None, None
 
+        from sqlalchemy import select
+
         pw = simple_hash(password)
+        users_table = get_storage().users
 
         with self.engine.connect() as conn:
             row = conn.execute(
@@ -175,12 +1002,122 @@ class UserAuth:
             ).fetchone()
 
         if row and row.password_hash == pw:
-            write_log(f"Login success: {username}")
+            write_log("Login success", username=username)
             return row.id, row.role
 
-        write_log(f"Login failed: {username}")
-        print("Incorrect username or password.")
-        return None, None 
+        write_log("Login failed", "WARNING", username=username)
+        return None, None
+
+    def login(self, username: str, password: str):
+        if not username or not password:
+            print("Empty login is not allowed.")
+            return None, None
+
+        user_id, role = self.check_credentials(username, password)
+        if user_id is None:
+            print("Incorrect username or password.")
+        return user_id, role
+
+    @metrics.timed("auth_seconds", method="create_token")
+    def create_token(self, user_id: int) -> str:
+        """Issues a new API token for scripts; only its hash is stored."""
+        import secrets
+        from sqlalchemy import insert
+
+        # A leading "-" would make "--token TOKEN" parse as an option.
+        token = secrets.token_urlsafe(32)
+        while token.startswith("-"):
+            token = secrets.token_urlsafe(32)
+        tokens_table = get_storage().tokens
+        run_write(
+            lambda conn: conn.execute(
+                insert(tokens_table).values(
+                    user_id=user_id,
+                    token_hash=hashlib.sha256(token.encode()).hexdigest(),
+                    created=datetime.now().strftime("%d-%m-%Y %H:%M"),
+                )
+            )
+        )
+        write_log("API token created", user_id=user_id)
+        return token
+
+    @metrics.timed("auth_seconds", method="login_with_token")
+    def login_with_token(self, token: str):
+        """Returns (user_id, role) for a valid API token."""
+        if not token:
+            return None, None
+
+        from sqlalchemy import select
+
+        storage = get_storage()
+        users_table, tokens_table = storage.users, storage.tokens
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(users_table.c.id, users_table.c.role)
+                .join(tokens_table, tokens_table.c.user_id == users_table.c.id)
+                .where(tokens_table.c.token_hash == token_hash)
+            ).fetchone()
+
+        if row:
+            return row.id, row.role
+
+        write_log("Token login failed", "WARNING")
+        return None, None
+
+
+# BULK INSERT
+
+
+HISTORY_COLUMNS = ("product_name", "price", "source", "date")
+
+
+def copy_text_value(value) -> str:
+    """Formats one value for PostgreSQL COPY ... FROM STDIN (text format)."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_history_rows(conn, rows: list) -> None:
+    """Streams history rows with COPY, using psycopg 3 or psycopg2."""
+    raw = conn.connection.driver_connection
+    sql = f"COPY history ({', '.join(HISTORY_COLUMNS)}) FROM STDIN"
+
+    if conn.dialect.driver == "psycopg":
+        with raw.cursor() as cur:
+            with cur.copy(sql) as copy:
+                for r in rows:
+                    copy.write_row(tuple(r[c] for c in HISTORY_COLUMNS))
+        return
+
+    buf = io.StringIO()
+    for r in rows:
+        buf.write("\t".join(copy_text_value(r[c]) for c in HISTORY_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    with raw.cursor() as cur:
+        cur.copy_expert(sql, buf)
+
+
+def bulk_insert_history(conn, rows: list) -> None:
+    """Inserts a batch of history rows the fastest way the backend allows."""
+    if not rows:
+        return
+    if conn.dialect.name == "postgresql" and conn.dialect.driver in ("psycopg", "psycopg2"):
+        copy_history_rows(conn, rows)
+        return
+
+    from sqlalchemy import insert
+
+    conn.execute(insert(get_storage().history), rows)
 
 
 #  DATABASE  WRAPPER
@@ -189,27 +1126,45 @@ class UserAuth:
 class Database:
     """Centralized wrapper for DB operations."""
 
-    def __init__(self):
-        self.engine = engine
+    @property
+    def engine(self):
+        return get_storage().engine
 
+    @metrics.timed("db_seconds", method="save_history")
     def save_history(self, name: str, prices_by_source: dict):
         now = datetime.now().strftime("%d-%m-%Y %H:%M")
-        with self.engine.begin() as conn:
-            for source, lst in prices_by_source.items():
-                for p in lst:
-                    conn.execute(
-                        insert(history_table).values(
-                            product_name=name,
-                            price=p,
-                            source=source,
-                            date=now,
-                        )
-                    )
+        rows = [
+            {"product_name": name, "price": p, "source": source, "date": now}
+            for source, lst in prices_by_source.items()
+            for p in lst
+        ]
+        if not rows:
+            return
+
+        # Rules must be read before this batch lands.
+        alerts = get_alert_engine()
+        entry = alerts.prepare(name)
+        low = alerts.batch_low(entry, prices_by_source)
+
+        def store(conn):
+            # One executemany (or COPY on PostgreSQL) per batch.
+            bulk_insert_history(conn, rows)
+            if low is not None and entry.new_low_rules:
+                return alerts.record_low(conn, name, low)
+            return None
 
+        previous_low = run_write(store)
+        if low is not None:
+            alerts.on_ingest(name, low, previous_low)
+
+    @metrics.timed("db_seconds", method="add_product")
     def add_product(self, user_id: int, product, score, trend, supply, consistency):
+        from sqlalchemy import insert
+
+        products_table = get_storage().products
         spread = product.max_price - product.min_price
-        with self.engine.begin() as conn:
-            conn.execute(
+        run_write(
+            lambda conn: conn.execute(
                 insert(products_table).values(
                     user_id=user_id,
                     name=product.name,
@@ -226,8 +1181,14 @@ class Database:
                     date_added=datetime.now().strftime("%d-%m-%Y %H:%M"),
                 )
             )
+        )
 
-    def list_products(self, user_id: int):
+    @metrics.timed("db_seconds", method="get_products")
+    def get_products(self, user_id: int):
+        """Returns the saved products of a user."""
+        from sqlalchemy import select
+
+        products_table = get_storage().products
         with self.engine.connect() as conn:
             rows = conn.execute(
                 select(
@@ -239,6 +1200,11 @@ class Database:
                     products_table.c.trend,
                 ).where(products_table.c.user_id == user_id)
             ).fetchall()
+        return rows
+
+    @metrics.timed("db_seconds", method="list_products")
+    def list_products(self, user_id: int):
+        rows = self.get_products(user_id)
 
         print("\n--- SAVED PRODUCTS ---\n")
         if not rows:
@@ -251,9 +1217,31 @@ class Database:
                 f"Avg: {r.avg_price:.2f} TL | Score: %{r.value_score} | Trend: {r.trend}"
             )
 
+    @metrics.timed("db_seconds", method="get_history")
     def get_history(self, name: str):
-        """Returns price history for a product."""
+        """
+        Returns price history for a product as HistoryPoints, oldest first:
+        weekly, daily and hourly rollups, then the raw recent prices.
+        """
+        from sqlalchemy import select
+
+        storage = get_storage()
+        history_table = storage.history
+        points = []
         with self.engine.connect() as conn:
+            for tier in ROLLUP_TIERS:
+                table = storage.rollups[tier]
+                for r in conn.execute(
+                    select(table)
+                    .where(table.c.product_name == name)
+                    .order_by(table.c.bucket_start.asc())
+                ):
+                    start = datetime.strptime(r.bucket_start, BUCKET_FORMAT)
+                    points.append(HistoryPoint(
+                        r.avg_price, r.source, start.strftime(RAW_DATE_FORMAT),
+                        r.min_price, r.max_price, r.count, tier,
+                    ))
+
             rows = conn.execute(
                 select(
                     history_table.c.price,
@@ -261,41 +1249,982 @@ class Database:
                     history_table.c.date,
                 ).where(history_table.c.product_name == name)
                 .order_by(history_table.c.id.asc())
-            ).fetchall()
-        return rows
+            )
+            points.extend(
+                HistoryPoint(r.price, r.source, r.date, r.price, r.price, 1, "raw")
+                for r in rows
+            )
+        return points
+
+    @metrics.timed("db_seconds", method="get_history_summary")
+    def get_history_summary(self, name: str, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)) -> dict:
+        return self.stream_history(name, quantiles).as_dict()
+
+    def stream_history(self, name: str, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """
+        Streams the stored prices of a product through a StreamingSummary,
+        so percentiles of long histories need bounded memory. Rolled-up
+        buckets count as many observations as they hold.
+        """
+        from sqlalchemy import select
 
+        storage = get_storage()
+        history_table = storage.history
+        summary = StreamingSummary(quantiles)
+
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True, yield_per=1000)
+            for tier in ROLLUP_TIERS:
+                table = storage.rollups[tier]
+                for r in conn.execute(
+                    select(table.c.avg_price, table.c.min_price, table.c.max_price, table.c.count)
+                    .where(table.c.product_name == name)
+                    .order_by(table.c.bucket_start.asc())
+                ):
+                    summary.add_bucket(r.avg_price, r.min_price, r.max_price, r.count)
+
+            for (price,) in conn.execute(
+                select(history_table.c.price)
+                .where(history_table.c.product_name == name, history_table.c.price > 0)
+                .order_by(history_table.c.id.asc())
+            ):
+                summary.add(price)
+
+        return summary
+
+    @metrics.timed("db_seconds", method="get_latest_price")
+    def get_latest_price(self, name: str):
+        """Most recent positive price stored for a product, or None."""
+        from sqlalchemy import select
+
+        storage = get_storage()
+        history_table = storage.history
+        with self.engine.connect() as conn:
+            price = conn.execute(
+                select(history_table.c.price)
+                .where(history_table.c.product_name == name, history_table.c.price > 0)
+                .order_by(history_table.c.id.desc())
+                .limit(1)
+            ).scalar()
+
+            # Nothing raw left: fall back to the newest rollup bucket.
+            for tier in reversed(ROLLUP_TIERS):
+                if price is not None:
+                    break
+                table = storage.rollups[tier]
+                price = conn.execute(
+                    select(table.c.avg_price)
+                    .where(table.c.product_name == name)
+                    .order_by(table.c.bucket_start.desc())
+                    .limit(1)
+                ).scalar()
+        return price
+
+    @metrics.timed("db_seconds", method="delete_product")
     def delete_product(self, product_id: int):
         """Deletes a product by ID."""
-        with self.engine.begin() as conn:
-            conn.execute(
+        from sqlalchemy import delete
+
+        products_table = get_storage().products
+        run_write(
+            lambda conn: conn.execute(
                 delete(products_table).where(products_table.c.id == product_id)
             )
+        )
 
+    @metrics.timed("db_seconds", method="get_product_by_id")
     def get_product_by_id(self, product_id: int):
         """Returns a single product by ID."""
+        from sqlalchemy import select
+
+        products_table = get_storage().products
         with self.engine.connect() as conn:
             row = conn.execute(
                 select(products_table).where(products_table.c.id == product_id)
             ).fetchone()
         return row
 
-    def get_all_products_for_similarity(self, user_id: int):
-        """Returns all products for similarity comparison."""
-        with self.engine.connect() as conn:
-            rows = conn.execute(
-                select(
-                    products_table.c.id,
-                    products_table.c.name,
-                    products_table.c.category,
-                    products_table.c.avg_price,
-                    products_table.c.min_price,
-                    products_table.c.max_price,
-                    products_table.c.value_score,
-                    products_table.c.trend,
-                ).where(products_table.c.user_id == user_id)
-                .order_by(products_table.c.id.asc())
-            ).fetchall()
-        return rows
+    @metrics.timed("db_seconds", method="get_products_by_names")
+    def get_products_by_names(self, user_id: int, names: list):
+        """
+        Returns the comparison fields of a user's products with the given
+        names: the latest saved row per name, in the order asked for.
+        Names the user never saved are left out.
+        """
+        from sqlalchemy import func, select
+
+        products_table = get_storage().products
+        latest = (
+            select(func.max(products_table.c.id))
+            .where(
+                products_table.c.user_id == user_id,
+                products_table.c.name.in_(names),
+            )
+            .group_by(products_table.c.name)
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(
+                    products_table.c.name,
+                    products_table.c.avg_price,
+                    products_table.c.value_score,
+                    products_table.c.trend,
+                    products_table.c.supply_level,
+                    products_table.c.consistency,
+                ).where(products_table.c.id.in_(latest))
+            ).fetchall()
+
+        by_name = {r.name: r for r in rows}
+        return [by_name[n] for n in dict.fromkeys(names) if n in by_name]
+
+    @metrics.timed("db_seconds", method="get_all_products_for_similarity")
+    def get_all_products_for_similarity(self, user_id: int):
+        """Returns all products for similarity comparison."""
+        from sqlalchemy import select
+
+        products_table = get_storage().products
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(
+                    products_table.c.id,
+                    products_table.c.name,
+                    products_table.c.category,
+                    products_table.c.avg_price,
+                    products_table.c.min_price,
+                    products_table.c.max_price,
+                    products_table.c.value_score,
+                    products_table.c.trend,
+                ).where(products_table.c.user_id == user_id)
+                .order_by(products_table.c.id.asc())
+            ).fetchall()
+        return rows
+
+# PRICE ALERTS
+#
+# Users watch a product with one of three rules:
+#   below   -> notify when a price <= threshold
+#   drop    -> notify when a price falls pct % under a baseline price
+#   new_low -> notify every time the product hits a new all-time low
+# "below" and "drop" fire once and are then switched off; "new_low" stays on.
+#
+# Rules are checked when save_history stores a batch, using an in-memory
+# index per product. Both one-shot kinds are reduced to a trigger price kept
+# in a sorted list, so a batch finds every matching rule with one bisect.
+# The index is loaded once per product and then kept current in place.
+
+
+ALERT_KINDS = ("below", "drop", "new_low")
+
+
+class FileAlertSink:
+    """Appends each alert as a JSON line to a local file."""
+
+    def __init__(self, path: str = "smartworth_alerts.jsonl"):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, alert: dict, done):
+        line = json.dumps(alert, ensure_ascii=False, default=str)
+        try:
+            with self.lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except OSError as e:
+            done(e)
+            return
+        done(None)
+
+
+class WebhookAlertSink:
+    """
+    POSTs each alert as JSON to a (local) webhook URL. Requests are sent
+    from a background thread so ingest never waits on the network; the
+    queue is drained at interpreter exit.
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        import atexit
+
+        self.url = url
+        self.timeout = timeout
+        self.pending = queue.Queue(maxsize=10_000)
+        self.thread = threading.Thread(
+            target=self._run, name="smartworth-webhook", daemon=True
+        )
+        self.thread.start()
+        # Registered after the logger, so failures are still logged on exit.
+        get_logger()
+        atexit.register(self.close)
+
+    def send(self, alert: dict, done):
+        try:
+            self.pending.put_nowait((alert, done))
+        except queue.Full as e:
+            metrics.incr("alert_dropped_total", sink="webhook")
+            done(e)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Delivers what is queued (up to timeout), then stops the thread."""
+        thread = self.thread
+        if thread is None:
+            return
+        try:
+            self.pending.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        from urllib.request import Request, urlopen
+
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            alert, done = item
+            body = json.dumps(alert, ensure_ascii=False, default=str).encode("utf-8")
+            req = Request(
+                self.url, data=body, method="POST",
+                headers={"Content-Type": "application/json"},
+            )
+            try:
+                with urlopen(req, timeout=self.timeout):
+                    pass
+            except Exception as e:
+                done(e)
+                continue
+            done(None)
+
+
+def load_alert_sink():
+    """
+    Sink from SMARTWORTH_ALERT_SINK: "file:PATH" (default
+    file:smartworth_alerts.jsonl) or "webhook:URL".
+    """
+    spec = os.environ.get("SMARTWORTH_ALERT_SINK", "file:smartworth_alerts.jsonl")
+    kind, _, target = spec.partition(":")
+    if kind == "webhook" and target:
+        return WebhookAlertSink(target)
+    return FileAlertSink(target or "smartworth_alerts.jsonl")
+
+
+class ProductAlerts:
+    """Index of the active rules of one product."""
+
+    def __init__(self, rules=()):
+        self.checked_at = time.monotonic()
+        self.max_rule_id = 0  # newest id read from the database
+        self.seen = set()  # ids ever indexed, so a refresh never adds one twice
+        self.new_low_rules = {}  # rule id -> rule dict
+
+        # One sort for the whole set instead of an insert per rule.
+        one_shot = []
+        for rule in rules:
+            self.max_rule_id = max(self.max_rule_id, rule["id"])
+            self.seen.add(rule["id"])
+            if rule["kind"] == "new_low":
+                self.new_low_rules[rule["id"]] = rule
+            else:
+                one_shot.append(rule)
+        one_shot.sort(key=lambda r: r["threshold"])
+        self.triggers = [r["threshold"] for r in one_shot]  # sorted trigger prices
+        self.trigger_rules = one_shot  # rule dicts, same order as triggers
+
+    def add(self, rule: dict):
+        from bisect import bisect_right
+
+        if rule["id"] in self.seen:
+            return
+        self.seen.add(rule["id"])
+        if rule["kind"] == "new_low":
+            self.new_low_rules[rule["id"]] = rule
+            return
+        i = bisect_right(self.triggers, rule["threshold"])
+        self.triggers.insert(i, rule["threshold"])
+        self.trigger_rules.insert(i, rule)
+
+    def remove(self, rule: dict):
+        from bisect import bisect_left, bisect_right
+
+        if rule["kind"] == "new_low":
+            self.new_low_rules.pop(rule["id"], None)
+            return
+        lo = bisect_left(self.triggers, rule["threshold"])
+        hi = bisect_right(self.triggers, rule["threshold"], lo)
+        for i in range(lo, hi):
+            if self.trigger_rules[i]["id"] == rule["id"]:
+                del self.triggers[i]
+                del self.trigger_rules[i]
+                return
+
+    @property
+    def empty(self) -> bool:
+        return not self.triggers and not self.new_low_rules
+
+    def restore(self, rule: dict):
+        """Puts back a rule taken out of the index by a failed delivery."""
+        self.seen.discard(rule["id"])
+        self.add(rule)
+
+
+RULE_FIELDS = ("id", "user_id", "kind", "threshold", "percent", "baseline")
+
+
+class AlertEngine:
+    """Evaluates watch rules incrementally as price batches are stored."""
+
+    def __init__(self, sink=None, index_ttl: float = 60.0):
+        self.sink = sink if sink is not None else load_alert_sink()
+        self.index_ttl = index_ttl  # look for rules added elsewhere after this
+        self.products = {}  # product name -> ProductAlerts
+        self.lock = threading.Lock()
+
+    def prepare(self, name: str) -> ProductAlerts:
+        """
+        Loads the active rules of a product on first use. Later
+        calls keep the index: add_rule / delete_rule update it in place,
+        and every index_ttl seconds only rules created by other processes
+        (ids above the newest one seen) are fetched.
+        """
+        entry = self.products.get(name)
+        if entry is None:
+            return self.load(name)
+        if time.monotonic() - entry.checked_at >= self.index_ttl:
+            self.refresh(name, entry)
+        return entry
+
+    def select_rules(self, conn, name: str, after_id: int = 0):
+        from sqlalchemy import select
+
+        rules_table = get_storage().alerts
+        rows = conn.execute(
+            select(*(rules_table.c[f] for f in RULE_FIELDS)).where(
+                rules_table.c.product_name == name,
+                rules_table.c.active == 1,
+                rules_table.c.id > after_id,
+            )
+        )
+        return [dict(zip(RULE_FIELDS, r)) for r in rows]
+
+    def load(self, name: str) -> ProductAlerts:
+        with get_storage().engine.connect() as conn:
+            rules = self.select_rules(conn, name)
+        entry = ProductAlerts(rules)
+        if entry.new_low_rules:
+            self.ensure_low(name)
+        with self.lock:
+            self.products[name] = entry
+        metrics.incr("alert_index_loads_total")
+        return entry
+
+    @staticmethod
+    def stored_low(name: str):
+        """
+        Lowest stored price, judged like a batch low in batch_low: values
+        outside the outlier bounds of the whole history do not count, so a
+        stray accessory price stored long ago cannot pin the low. The
+        bounds come from a streamed digest and the minimum from SQL, so
+        long histories are never held in memory.
+        """
+        from sqlalchemy import func, select
+
+        storage = get_storage()
+        history_table = storage.history
+        summary = Database().stream_history(name, ())
+        digest = summary.digest
+        if not digest.total:
+            return None
+        # Like price_bounds, fewer than three prices cannot be judged.
+        lower, upper = summary.bounds() if digest.total >= 3 else (digest.min, digest.max)
+
+        def low_of(column):
+            return func.min(column).filter(column.between(lower, upper))
+
+        queries = [
+            select(low_of(history_table.c.price)).where(
+                history_table.c.product_name == name, history_table.c.price > 0
+            )
+        ] + [
+            select(low_of(table.c.min_price), low_of(table.c.avg_price))
+            .where(table.c.product_name == name)
+            for table in storage.rollups.values()
+        ]
+        with storage.engine.connect() as conn:
+            lows = [v for q in queries for v in conn.execute(q).one() if v is not None]
+        return min(lows) if lows else None
+
+    def refresh(self, name: str, entry: ProductAlerts):
+        with get_storage().engine.connect() as conn:
+            rules = self.select_rules(conn, name, entry.max_rule_id)
+        with self.lock:
+            entry.checked_at = time.monotonic()
+            for rule in rules:
+                entry.max_rule_id = max(entry.max_rule_id, rule["id"])
+                entry.add(rule)
+        if any(r["kind"] == "new_low" for r in rules):
+            self.ensure_low(name)
+
+    def ensure_low(self, name: str):
+        """
+        Seeds the product's row in price_lows from its history. The row
+        exists while the product has new_low rules; every process that
+        stores prices for it keeps it current in record_low.
+        """
+        from sqlalchemy import insert, select
+
+        lows = get_storage().lows
+        current = select(lows.c.low).where(lows.c.product_name == name)
+        with get_storage().engine.connect() as conn:
+            if conn.execute(current).first() is not None:
+                return
+        low = self.stored_low(name)
+
+        def seed(conn):
+            if conn.execute(current).first() is not None:
+                return
+            conn.execute(insert(lows).values(
+                product_name=name, low=low,
+                updated=datetime.now().strftime("%d-%m-%Y %H:%M"),
+            ))
+
+        run_write(seed)
+
+    def record_low(self, conn, name: str, low: float):
+        """
+        Runs inside the transaction that stores the batch, so the check
+        and the update are atomic across processes. Returns the previous
+        low when the batch set a new one, else None.
+        """
+        from sqlalchemy import insert, select, update
+
+        lows = get_storage().lows
+        now = datetime.now().strftime("%d-%m-%Y %H:%M")
+        row = conn.execute(
+            select(lows.c.low).where(lows.c.product_name == name).with_for_update()
+        ).first()
+        if row is None:
+            conn.execute(insert(lows).values(product_name=name, low=low, updated=now))
+            return None
+        if row.low is not None and low >= row.low:
+            return None
+        conn.execute(
+            update(lows).where(lows.c.product_name == name).values(low=low, updated=now)
+        )
+        # The very first price of a product is not a "new low".
+        return row.low
+
+    def forget(self, name: str):
+        with self.lock:
+            self.products.pop(name, None)
+
+    @staticmethod
+    def batch_low(entry: ProductAlerts, prices_by_source: dict):
+        """Lowest plausible price of a batch; None when no rule needs it."""
+        if entry.empty:
+            return None
+        # A stray accessory price must not look like a price drop.
+        valid = filter_outliers([p for lst in prices_by_source.values() for p in lst if p > 0])
+        return min(valid) if valid else None
+
+    def on_ingest(self, name: str, low: float, previous_low=None):
+        """
+        Checks one stored batch against the product's rules. previous_low
+        is what record_low returned: set only when the batch is a new low.
+        """
+        entry = self.prepare(name)
+        fired = []
+        with self.lock:
+            from bisect import bisect_left
+
+            # Every one-shot rule whose trigger price is >= the batch low.
+            i = bisect_left(entry.triggers, low)
+            if i < len(entry.triggers):
+                fired.extend(entry.trigger_rules[i:])
+                del entry.triggers[i:]
+                del entry.trigger_rules[i:]
+            if previous_low is not None:
+                fired.extend(entry.new_low_rules.values())
+
+        metrics.incr("alert_checks_total")
+        if fired:
+            self._notify(name, low, previous_low, fired)
+
+    def _notify(self, name, price, previous_low, rules):
+        """
+        Hands one alert per rule to the sink. A one-shot rule is switched
+        off only once its alert has been delivered; if delivery fails it
+        goes back into the index and fires again on the next low enough
+        batch. Delivery is at-least-once: two processes storing prices at
+        the same moment may both send the same rule.
+        """
+        now = datetime.now().strftime("%d-%m-%Y %H:%M")
+
+        # Rules deleted or fired by another process since they were
+        # indexed are skipped.
+        live = self.active_ids([r["id"] for r in rules])
+        stale = [r for r in rules if r["id"] not in live]
+        if stale:
+            with self.lock:
+                entry = self.products.get(name)
+                for rule in stale:
+                    if entry is not None:
+                        entry.remove(rule)
+            rules = [r for r in rules if r["id"] in live]
+
+        for rule in rules:
+            alert = {
+                "rule_id": rule["id"],
+                "user_id": rule["user_id"],
+                "product_name": name,
+                "kind": rule["kind"],
+                "price": price,
+                "threshold": rule["threshold"],
+                "percent": rule["percent"],
+                "baseline": rule["baseline"],
+                "previous_low": previous_low,
+                "triggered_at": now,
+            }
+            done = functools.partial(self._delivered, name, rule, now)
+            try:
+                self.sink.send(alert, done)
+            except Exception as e:
+                done(e)
+
+    def active_ids(self, ids: list) -> set:
+        from sqlalchemy import select
+
+        rules_table = get_storage().alerts
+        with get_storage().engine.connect() as conn:
+            return set(conn.execute(
+                select(rules_table.c.id).where(
+                    rules_table.c.id.in_(ids), rules_table.c.active == 1
+                )
+            ).scalars())
+
+    def _delivered(self, name: str, rule: dict, now: str, error):
+        """Sink callback, possibly from the sink's own thread."""
+        from sqlalchemy import update
+
+        if error is not None:
+            metrics.incr("alert_send_errors_total", sink=type(self.sink).__name__)
+            write_log("Alert delivery failed", "ERROR", rule_id=rule["id"], error=str(error))
+            if rule["kind"] != "new_low":
+                with self.lock:
+                    entry = self.products.get(name)
+                    if entry is not None:
+                        entry.restore(rule)
+            return
+
+        metrics.incr("alerts_sent_total", kind=rule["kind"])
+        if rule["kind"] == "new_low":
+            return
+        rules_table = get_storage().alerts
+        try:
+            run_write(lambda conn: conn.execute(
+                update(rules_table)
+                .where(rules_table.c.id == rule["id"], rules_table.c.active == 1)
+                .values(active=0, triggered_at=now)
+            ))
+        except Exception as e:
+            write_log("Alert rule update failed", "ERROR", rule_id=rule["id"], error=str(e))
+
+    # rule management
+
+    def add_rule(self, user_id: int, name: str, kind: str, threshold=None,
+                 percent=None, baseline=None) -> dict:
+        """Validates and stores a rule; returns it as a dict."""
+        from sqlalchemy import insert
+
+        if kind not in ALERT_KINDS:
+            raise ValueError(f"unknown alert kind '{kind}'")
+        if kind == "below" and (threshold is None or threshold <= 0):
+            raise ValueError("'below' needs a positive price")
+        if kind == "drop":
+            if percent is None or not 0 < percent < 100:
+                raise ValueError("'drop' needs a percentage between 0 and 100")
+            if baseline is None:
+                baseline = Database().get_latest_price(name)
+            if not baseline or baseline <= 0:
+                raise ValueError("no price recorded yet; give a baseline price")
+            threshold = baseline * (1 - percent / 100)
+
+        rule = {
+            "user_id": user_id,
+            "product_name": name,
+            "kind": kind,
+            "threshold": threshold,
+            "percent": percent,
+            "baseline": baseline,
+            "active": 1,
+            "created": datetime.now().strftime("%d-%m-%Y %H:%M"),
+            "triggered_at": None,
+        }
+        rules_table = get_storage().alerts
+        rule["id"] = run_write(
+            lambda conn: conn.execute(insert(rules_table).values(**rule))
+        ).inserted_primary_key[0]
+
+        with self.lock:
+            entry = self.products.get(name)
+            if entry is not None:
+                entry.add(rule)
+        if kind == "new_low":
+            self.ensure_low(name)
+        return rule
+
+    def list_rules(self, user_id: int):
+        from sqlalchemy import select
+
+        rules_table = get_storage().alerts
+        with get_storage().engine.connect() as conn:
+            return conn.execute(
+                select(rules_table)
+                .where(rules_table.c.user_id == user_id)
+                .order_by(rules_table.c.id.asc())
+            ).fetchall()
+
+    def delete_rule(self, user_id: int, rule_id: int) -> bool:
+        from sqlalchemy import delete, select
+
+        rules_table = get_storage().alerts
+
+        def remove(conn):
+            row = conn.execute(
+                select(
+                    rules_table.c.product_name,
+                    *(rules_table.c[f] for f in RULE_FIELDS),
+                ).where(
+                    rules_table.c.id == rule_id,
+                    rules_table.c.user_id == user_id,
+                )
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(delete(rules_table).where(rules_table.c.id == rule_id))
+            if row.kind == "new_low" and conn.execute(
+                select(rules_table.c.id).where(
+                    rules_table.c.product_name == row.product_name,
+                    rules_table.c.kind == "new_low",
+                    rules_table.c.active == 1,
+                ).limit(1)
+            ).first() is None:
+                # Untracked from here on, so it would go stale; reseeded if needed.
+                lows = get_storage().lows
+                conn.execute(delete(lows).where(lows.c.product_name == row.product_name))
+            return row
+
+        row = run_write(remove)
+        if row is None:
+            return False
+
+        with self.lock:
+            entry = self.products.get(row.product_name)
+            if entry is not None:
+                entry.remove(dict(zip(RULE_FIELDS, row[1:])))
+        return True
+
+
+_alert_engine = None
+
+
+def get_alert_engine() -> AlertEngine:
+    global _alert_engine
+    if _alert_engine is None:
+        _alert_engine = AlertEngine()
+    return _alert_engine
+
+
+# HISTORY RETENTION
+#
+# Raw prices are kept for a recent window only. Older data is folded into
+# rollup tiers with min / avg / max / count per product, source and bucket:
+#   raw  --(raw_days)-->  hourly  --(hourly_days)-->  daily  --(daily_days)-->  weekly
+# Database.get_history reads all tiers, so callers still see one series.
+# Run "python smartworth.py compact" from cron to apply the policy.
+
+
+ROLLUP_TIERS = ("weekly", "daily", "hourly")  # oldest data first
+BUCKET_FORMAT = "%Y-%m-%d %H:%M"  # sortable, unlike the raw "date" column
+RAW_DATE_FORMAT = "%d-%m-%Y %H:%M"
+
+
+@dataclass
+class RetentionPolicy:
+    """How long each tier keeps its data before moving to the next one."""
+    raw_days: int = 30
+    hourly_days: int = 180
+    daily_days: int = 730
+
+
+@dataclass
+class HistoryPoint:
+    """One point of a price series, raw or rolled up."""
+    price: float       # the price, or the bucket average for rollups
+    source: str
+    date: str          # same "%d-%m-%Y %H:%M" format as raw history
+    min_price: float
+    max_price: float
+    count: int
+    tier: str          # raw | hourly | daily | weekly
+
+
+def bucket_start(dt: datetime, tier: str) -> str:
+    if tier == "hourly":
+        dt = dt.replace(minute=0, second=0, microsecond=0)
+    elif tier == "daily":
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        from datetime import timedelta
+
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        dt -= timedelta(days=dt.weekday())  # Monday of that week
+    return dt.strftime(BUCKET_FORMAT)
+
+
+def merge_stats(a: dict, b: dict) -> dict:
+    """Combines two min/avg/max/count aggregates."""
+    count = a["count"] + b["count"]
+    return {
+        "min_price": min(a["min_price"], b["min_price"]),
+        "max_price": max(a["max_price"], b["max_price"]),
+        "avg_price": (a["avg_price"] * a["count"] + b["avg_price"] * b["count"]) / count,
+        "count": count,
+    }
+
+
+class HistoryCompactor:
+    """
+    Applies a RetentionPolicy in bounded chunks. Every chunk is its own
+    short write transaction, so ingest keeps running while a large backlog
+    is compacted.
+    """
+
+    def __init__(self, policy: RetentionPolicy = None, chunk_size: int = 2000,
+                 max_chunks: int = 0, vacuum_pages: int = 1000):
+        self.policy = policy or RetentionPolicy()
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks  # 0 = no limit
+        self.vacuum_pages = vacuum_pages  # free pages released per chunk
+        self.chunks = 0
+        self.incremental = False
+
+    def run(self, full_vacuum: bool = False, now: datetime = None) -> dict:
+        """
+        Runs every stage; returns how many rows each stage folded. SQLite
+        files in auto_vacuum=INCREMENTAL mode give space back after each
+        chunk. full_vacuum also rewrites the whole file at the end, which
+        holds the write lock for as long as that takes.
+        """
+        from datetime import timedelta
+
+        now = now or datetime.now()
+        storage = get_storage()
+        p = self.policy
+        self.chunks = 0
+        self.incremental = False
+        if storage.engine.dialect.name == "sqlite":
+            with storage.engine.connect() as conn:
+                # 2 = INCREMENTAL
+                self.incremental = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+        stats = {
+            "raw_to_hourly": self.compact_raw(now - timedelta(days=p.raw_days)),
+            "hourly_to_daily": self.roll_up(
+                storage.rollups["hourly"], "daily", now - timedelta(days=p.hourly_days)
+            ),
+            "daily_to_weekly": self.roll_up(
+                storage.rollups["daily"], "weekly", now - timedelta(days=p.daily_days)
+            ),
+            "chunks": self.chunks,
+            "vacuum": "incremental" if self.incremental else "none",
+        }
+        folded = any(stats[k] for k in ("raw_to_hourly", "hourly_to_daily", "daily_to_weekly"))
+        if full_vacuum or (folded and storage.engine.dialect.name == "postgresql"):
+            stats["vacuum"] = self.vacuum() or "failed"
+        write_log("History compacted", **stats)
+        return stats
+
+    def _budget_left(self) -> bool:
+        return not self.max_chunks or self.chunks < self.max_chunks
+
+    def _reclaim(self, conn):
+        """Releases up to vacuum_pages free pages inside the chunk's write."""
+        if not self.incremental:
+            return
+        free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        # pysqlite steps a PRAGMA only once, and incremental_vacuum frees
+        # one page per step, so ask for one page at a time.
+        for _ in range(min(free, self.vacuum_pages)):
+            conn.exec_driver_sql("PRAGMA incremental_vacuum(1)")
+
+    def compact_raw(self, cutoff: datetime) -> int:
+        """
+        Folds raw rows older than cutoff into the hourly tier. Raw rows are
+        appended in time order, so the scan walks ids and stops at the first
+        row inside the raw window.
+        """
+        from sqlalchemy import select, delete
+
+        storage = get_storage()
+        history_table = storage.history
+        folded, cursor = 0, 0
+
+        while self._budget_left():
+            with storage.engine.connect() as conn:
+                rows = conn.execute(
+                    select(
+                        history_table.c.id,
+                        history_table.c.product_name,
+                        history_table.c.price,
+                        history_table.c.source,
+                        history_table.c.date,
+                    )
+                    .where(history_table.c.id > cursor)
+                    .order_by(history_table.c.id.asc())
+                    .limit(self.chunk_size)
+                ).fetchall()
+            if not rows:
+                break
+
+            ids, points, reached_window = [], [], False
+            for r in rows:
+                cursor = r.id
+                try:
+                    dt = datetime.strptime(r.date, RAW_DATE_FORMAT)
+                except (TypeError, ValueError):
+                    continue  # unreadable date: leave the row alone
+                if dt >= cutoff:
+                    reached_window = True
+                    break
+                ids.append(r.id)
+                # 0.0 marks a failed scrape: dropped, not averaged in.
+                if r.price and r.price > 0:
+                    points.append((r.product_name, r.source, dt, r.price))
+
+            if ids:
+                aggregates = {}
+                for name, source, dt, price in points:
+                    key = (name, source, bucket_start(dt, "hourly"))
+                    stats = {"min_price": price, "max_price": price, "avg_price": price, "count": 1}
+                    aggregates[key] = merge_stats(aggregates[key], stats) if key in aggregates else stats
+
+                def job(conn, ids=ids, aggregates=aggregates):
+                    self._merge_into(conn, storage.rollups["hourly"], aggregates)
+                    conn.execute(delete(history_table).where(history_table.c.id.in_(ids)))
+                    self._reclaim(conn)
+
+                run_write(job)
+                folded += len(ids)
+                self.chunks += 1
+
+            if reached_window:
+                break
+
+        return folded
+
+    def roll_up(self, source_table, tier: str, cutoff: datetime) -> int:
+        """Moves source_table buckets that start before cutoff into `tier`."""
+        from sqlalchemy import select, delete
+
+        storage = get_storage()
+        limit = cutoff.strftime(BUCKET_FORMAT)
+        folded = 0
+
+        while self._budget_left():
+            with storage.engine.connect() as conn:
+                rows = conn.execute(
+                    select(source_table)
+                    .where(source_table.c.bucket_start < limit)
+                    .order_by(source_table.c.id.asc())
+                    .limit(self.chunk_size)
+                ).fetchall()
+            if not rows:
+                break
+
+            aggregates = {}
+            for r in rows:
+                dt = datetime.strptime(r.bucket_start, BUCKET_FORMAT)
+                key = (r.product_name, r.source, bucket_start(dt, tier))
+                stats = {
+                    "min_price": r.min_price, "max_price": r.max_price,
+                    "avg_price": r.avg_price, "count": r.count,
+                }
+                aggregates[key] = merge_stats(aggregates[key], stats) if key in aggregates else stats
+            ids = [r.id for r in rows]
+
+            def job(conn, ids=ids, aggregates=aggregates):
+                self._merge_into(conn, storage.rollups[tier], aggregates)
+                conn.execute(delete(source_table).where(source_table.c.id.in_(ids)))
+                self._reclaim(conn)
+
+            run_write(job)
+            folded += len(ids)
+            self.chunks += 1
+
+        return folded
+
+    @staticmethod
+    def _merge_into(conn, table, aggregates: dict):
+        """Adds aggregates to existing buckets of table, or inserts them."""
+        if not aggregates:
+            return
+        from sqlalchemy import select, insert, update
+
+        names = {k[0] for k in aggregates}
+        starts = {k[2] for k in aggregates}
+        existing = {
+            (r.product_name, r.source, r.bucket_start): r
+            for r in conn.execute(
+                select(table).where(
+                    table.c.product_name.in_(names),
+                    table.c.bucket_start.in_(starts),
+                )
+            )
+        }
+
+        new_rows = []
+        for (name, source, start), stats in aggregates.items():
+            old = existing.get((name, source, start))
+            if old is None:
+                new_rows.append(
+                    {"product_name": name, "source": source, "bucket_start": start, **stats}
+                )
+                continue
+            merged = merge_stats(
+                {"min_price": old.min_price, "max_price": old.max_price,
+                 "avg_price": old.avg_price, "count": old.count},
+                stats,
+            )
+            conn.execute(update(table).where(table.c.id == old.id).values(**merged))
+
+        if new_rows:
+            conn.execute(insert(table), new_rows)
+
+    def vacuum(self) -> str:
+        """
+        SQLite: full VACUUM (also switches the file to the profile's
+        auto_vacuum mode). PostgreSQL: plain VACUUM (ANALYZE), which does
+        not block readers or writers. Returns "" if the database was busy.
+        """
+        from sqlalchemy.exc import OperationalError
+
+        storage = get_storage()
+        dialect = storage.engine.dialect.name
+        try:
+            with storage.engine.connect() as conn:
+                conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                if dialect == "sqlite":
+                    conn.exec_driver_sql("VACUUM")
+                    if storage.profile.journal_mode.upper() == "WAL":
+                        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+                elif dialect == "postgresql":
+                    for table in ["history"] + [f"history_{t}" for t in ROLLUP_TIERS]:
+                        conn.exec_driver_sql(f"VACUUM (ANALYZE) {table}")
+        except OperationalError as e:
+            write_log("Vacuum skipped", "WARNING", error=str(e))
+            return ""
+        return "full" if dialect == "sqlite" else "analyze"
+
 
 # DOMAIN MODEL
 
@@ -457,24 +2386,271 @@ class SupplyDemandAnalyzer:
 
 
 
+# ROBUST AGGREGATION
+#
+# Scraped price lists often contain garbage (accessory prices, shipping
+# fees, a "2024" that looked like a number). Everything that summarizes
+# prices goes through these helpers instead of a plain mean:
+#   filter_outliers   -> drops values far from the median (MAD, IQR fallback)
+#   robust_price_summary -> weighted mean / median / min / max per analysis
+#   TDigest, StreamingSummary -> percentiles of long histories in bounded memory
+
+
+# How much one price from each source counts; Google snippets are noisier.
+SOURCE_WEIGHTS = {"trendyol": 1.0, "google": 0.6}
+
+MAD_CUTOFF = 3.5  # modified z-score above which a value is an outlier
+
+
+def median(values: list) -> float:
+    return quantile(sorted(values), 0.5)
+
+
+def quantile(sorted_values: list, q: float) -> float:
+    """Linear-interpolated quantile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def outlier_bounds(center: float, mad: float, q1: float, q3: float) -> tuple:
+    """
+    (low, high) range of acceptable values: modified z-score
+    (0.6745 * |x - median| / MAD) within MAD_CUTOFF. When over half the
+    values are equal (MAD = 0) the 1.5 * IQR fences are used, and failing
+    that a 50 % band around the median.
+    """
+    if mad > 0:
+        reach = MAD_CUTOFF * mad / 0.6745
+        return center - reach, center + reach
+    iqr = q3 - q1
+    if iqr > 0:
+        return q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    return center - 0.5 * abs(center), center + 0.5 * abs(center)
+
+
+def price_bounds(values: list) -> tuple:
+    """outlier_bounds of a list; None when fewer than three values."""
+    if len(values) < 3:
+        return None
+    ordered = sorted(values)
+    center = quantile(ordered, 0.5)
+    mad = median([abs(v - center) for v in ordered])
+    return outlier_bounds(center, mad, quantile(ordered, 0.25), quantile(ordered, 0.75))
+
+
+def filter_outliers(values: list) -> list:
+    """
+    Keeps the values inside price_bounds. Fewer than three values cannot
+    be judged and are returned unchanged.
+    """
+    bounds = price_bounds(values)
+    if bounds is None:
+        return list(values)
+    low, high = bounds
+    return [v for v in values if low <= v <= high]
+
+
+def robust_price_summary(prices_by_source: dict) -> dict:
+    """
+    Drops failed scrapes (<= 0) and outliers across all sources, then
+    returns a source-weighted mean plus median / min / max of what is left.
+    """
+    pairs = [
+        (p, source)
+        for source, lst in prices_by_source.items()
+        for p in lst
+        if p > 0
+    ]
+    kept_values = filter_outliers([p for p, _ in pairs])
+    if not kept_values:
+        return {
+            "avg_price": 0.0, "median": 0.0, "min_price": 0.0,
+            "max_price": 0.0, "kept": [], "dropped": 0,
+        }
+
+    low, high = min(kept_values), max(kept_values)
+    kept = [(p, s) for p, s in pairs if low <= p <= high]
+    total_weight = sum(SOURCE_WEIGHTS.get(s, 1.0) for _, s in kept)
+    avg = sum(p * SOURCE_WEIGHTS.get(s, 1.0) for p, s in kept) / total_weight
+
+    return {
+        "avg_price": avg,
+        "median": median(kept_values),
+        "min_price": low,
+        "max_price": high,
+        "kept": [p for p, _ in kept],
+        "dropped": len(pairs) - len(kept),
+    }
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning): a weighted quantile sketch in bounded
+    memory. Centroids are kept small near the tails, so extreme
+    percentiles stay accurate, and unlike P² the result does not depend
+    on the order of the input (history is read oldest first, which for a
+    steadily moving price is close to sorted).
+    """
+
+    def __init__(self, compression: int = 100):
+        self.compression = compression
+        self.centroids = []  # (mean, weight), sorted by mean
+        self.buffer = []
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x: float, weight: float = 1.0):
+        if weight <= 0:
+            return
+        self.buffer.append((x, weight))
+        self.total += weight
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        if len(self.buffer) >= 5 * self.compression:
+            self._merge()
+
+    def _limit(self, q: float) -> float:
+        """Cumulative fraction the centroid starting at q may grow to (k1 scale)."""
+        delta = self.compression
+        k = delta / (2 * math.pi) * math.asin(min(1.0, max(-1.0, 2 * q - 1))) + 1
+        return (math.sin(min(k * 2 * math.pi / delta, math.pi / 2)) + 1) / 2
+
+    def _merge(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+
+        merged, done = [], 0.0
+        mean, weight = points[0]
+        limit = self._limit(0.0)
+        for x, w in points[1:]:
+            if (done + weight + w) / self.total <= limit:
+                weight += w
+                mean += (x - mean) * w / weight
+            else:
+                merged.append((mean, weight))
+                done += weight
+                limit = self._limit(done / self.total)
+                mean, weight = x, w
+        merged.append((mean, weight))
+        self.centroids = merged
+
+    def weighted(self) -> list:
+        """All centroids as (mean, weight), sorted."""
+        self._merge()
+        return self.centroids
+
+    def quantile(self, q: float):
+        centroids = self.weighted()
+        if not centroids:
+            return None
+        target = q * self.total
+        prev_center, prev_mean = 0.0, self.min
+        cum = 0.0
+        for mean, w in centroids:
+            center = cum + w / 2
+            if target <= center:
+                span = center - prev_center
+                t = (target - prev_center) / span if span > 0 else 0.0
+                return prev_mean + (mean - prev_mean) * t
+            prev_center, prev_mean = center, mean
+            cum += w
+        span = self.total - prev_center
+        t = (target - prev_center) / span if span > 0 else 0.0
+        return prev_mean + (self.max - prev_mean) * t
+
+
+class StreamingSummary:
+    """
+    Count / mean / min / max and percentiles over a stream of prices, in
+    bounded memory. Rolled-up buckets count with their full weight. The
+    mean, min and max leave out values beyond outlier_bounds, as the
+    analyses do; "outliers" is the (estimated) number left out.
+    """
+
+    def __init__(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        self.quantiles = quantiles
+        self.digest = TDigest()
+
+    def add(self, x: float, weight: int = 1):
+        self.digest.add(x, weight)
+
+    def add_bucket(self, avg: float, low: float, high: float, count: int):
+        """
+        A rollup bucket: its min and max once each, and the other count - 2
+        prices at their own average, so spread, weight and sum are all kept.
+        """
+        if count < 2 or low == high:
+            self.digest.add(avg, count)
+            return
+        self.digest.add(low, 1)
+        self.digest.add(high, 1)
+        if count > 2:
+            self.digest.add((avg * count - low - high) / (count - 2), count - 2)
+
+    def bounds(self) -> tuple:
+        """outlier_bounds estimated from the digest."""
+        d = self.digest
+        center = d.quantile(0.5)
+        deviations = sorted((abs(m - center), w) for m, w in d.weighted())
+        cum, mad = 0.0, 0.0
+        for dev, w in deviations:
+            cum += w
+            if cum >= d.total / 2:
+                mad = dev
+                break
+        return outlier_bounds(center, mad, d.quantile(0.25), d.quantile(0.75))
+
+    def as_dict(self) -> dict:
+        d = self.digest
+        result = {"count": round(d.total), "mean": None, "min": None, "max": None, "outliers": 0}
+        if d.total:
+            lower, upper = self.bounds()
+            kept = [(m, w) for m, w in d.weighted() if lower <= m <= upper]
+            if not kept:
+                kept = [(d.quantile(0.5), d.total)]
+            kept_weight = sum(w for _m, w in kept)
+            result.update(
+                mean=sum(m * w for m, w in kept) / kept_weight,
+                # The exact extremes when they pass, else the nearest centroid.
+                min=d.min if d.min >= lower else kept[0][0],
+                max=d.max if d.max <= upper else kept[-1][0],
+                outliers=round(d.total - kept_weight),
+            )
+        for q in self.quantiles:
+            result[f"p{int(round(q * 100))}"] = d.quantile(q) if d.total else None
+        return result
+
+
 # CONSISTENCY CHECKER
 
 
 class PriceConsistencyChecker:
-    """Measures consistency between Google and Trendyol price averages."""
+    """
+    Measures consistency between the Google and Trendyol prices. Each source
+    is reduced to the median of its outlier-filtered prices, and sources are
+    combined with SOURCE_WEIGHTS.
+    """
 
     def calculate_consistency(self, prices_by_source: dict) -> float:
-        averages = []
-        for lst in prices_by_source.values():
-            valid = [p for p in lst if p > 0]
+        centers = []
+        for source, lst in prices_by_source.items():
+            valid = filter_outliers([p for p in lst if p > 0])
             if valid:
-                averages.append(sum(valid) / len(valid))
+                centers.append((median(valid), SOURCE_WEIGHTS.get(source, 1.0)))
 
-        if len(averages) <= 1:
+        if len(centers) <= 1:
             return 100.0
 
-        global_avg = sum(averages) / len(averages)
-        max_dev = max(abs(a - global_avg) for a in averages)
+        total_weight = sum(w for _, w in centers)
+        global_avg = sum(c * w for c, w in centers) / total_weight
+        max_dev = max(abs(c - global_avg) for c, _ in centers)
         consistency = max(0.0, 100.0 - (max_dev / global_avg) * 100)
 
         return round(consistency, 2)
@@ -523,62 +2699,128 @@ class SimilarityFinder:
 # SCRAPERS
 
 
+class ScraperSessionPool:
+    """
+    Shared requests sessions, so repeated scrapes reuse keep-alive
+    connections instead of opening a new one per request.
+    """
+
+    def __init__(self, size: int = 8):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self):
+        s = self._acquire()
+        try:
+            yield s
+        finally:
+            self.idle.put(s)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                import requests
+
+                self.created += 1
+                s = requests.Session()
+                s.headers["User-Agent"] = "Mozilla/5.0"
+                return s
+
+        # Pool is full: wait for another scraper to hand one back.
+        return self.idle.get()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
 class GoogleScraper:
     """Attempts to retrieve price snippets from Google."""
 
-    def __init__(self, product_name: str):
+    def __init__(self, product_name: str, session=None):
         q = product_name.replace(" ", "+")
         self.url = f"https://www.google.com/search?q={q}+price"
         self.headers = {"User-Agent": "Mozilla/5.0"}
+        self.session = session
 
     def get_data(self):
+        import requests
+        from bs4 import BeautifulSoup
+
+        http = self.session or requests
         try:
-            resp = requests.get(self.url, headers=self.headers, timeout=6)
+            with metrics.timer("scrape_fetch_seconds", source="google"):
+                resp = http.get(self.url, headers=self.headers, timeout=6)
         except Exception as e:
-            write_log(f"Google error: {e}")
+            write_log("Scrape failed", "WARNING", source="google", url=self.url, error=str(e))
             return [0.0], "No description found."
 
-        soup = BeautifulSoup(resp.text, "html.parser")
-        prices = []
+        with metrics.timer("html_parse_seconds", source="google"):
+            soup = BeautifulSoup(resp.text, "html.parser")
+            prices = []
 
-        for span in soup.find_all("span", limit=8):
-            p = normalize_price_text(span.get_text())
-            if p > 0:
-                prices.append(p)
+            for span in soup.find_all("span", limit=8):
+                text = span.get_text()
+                # Bare numbers here are usually years, ratings or counts.
+                if not looks_like_price(text):
+                    continue
+                p = normalize_price_text(text)
+                if p > 0:
+                    prices.append(p)
 
-        if not prices:
-            prices = [0.0]
+            if not prices:
+                metrics.incr("scrape_empty_total", source="google")
+                prices = [0.0]
 
-        desc_tag = soup.find("div")
-        desc = desc_tag.get_text(strip=True) if desc_tag else "No description found."
+            desc_tag = soup.find("div")
+            desc = desc_tag.get_text(strip=True) if desc_tag else "No description found."
 
         return prices, desc[:400]
 
 class TrendyolScraper:
     """Lightweight fallback scraper for Trendyol."""
 
-    def __init__(self, product_name: str):
+    def __init__(self, product_name: str, session=None):
         q = product_name.replace(" ", "+")
         self.url = f"https://www.trendyol.com/sr?q={q}"
         self.headers = {"User-Agent": "Mozilla/5.0"}
+        self.session = session
 
     
     def get_data(self):
+        import requests
+        from bs4 import BeautifulSoup
+
+        http = self.session or requests
         try:
-            resp = requests.get(self.url, headers=self.headers, timeout=6)
+            with metrics.timer("scrape_fetch_seconds", source="trendyol"):
+                resp = http.get(self.url, headers=self.headers, timeout=6)
         except Exception as e:
-            write_log(f"Trendyol error: {e}")
+            write_log("Scrape failed", "WARNING", source="trendyol", url=self.url, error=str(e))
             return [0.0]
 
-        soup = BeautifulSoup(resp.text, "html.parser")
-        prices = []
+        with metrics.timer("html_parse_seconds", source="trendyol"):
+            soup = BeautifulSoup(resp.text, "html.parser")
+            prices = []
 
-        for div in soup.find_all("div", {"class": "prc-box-dscntd"}, limit=6):
-            p = normalize_price_text(div.get_text())
-            if p > 0:
-                prices.append(p)
+            for div in soup.find_all("div", {"class": "prc-box-dscntd"}, limit=6):
+                p = normalize_price_text(div.get_text())
+                if p > 0:
+                    prices.append(p)
 
         if not prices:
+            metrics.incr("scrape_empty_total", source="trendyol")
             prices = [0.0]
 
         return prices
@@ -619,23 +2861,131 @@ def choose_analyzer(cat: str, desc: str) -> AnalyzerBase:
 
 
 
+# ANALYSIS PIPELINE
+
+
+@metrics.timed("evaluate_seconds")
+def evaluate_product(name: str, sessions: ScraperSessionPool = None) -> dict:
+    """Scrapes and scores one product without saving anything."""
+    # Scrapers
+    borrow = sessions.session() if sessions else contextlib.nullcontext()
+    with borrow as session:
+        google = GoogleScraper(name, session)
+        g_prices, desc = google.get_data()
+
+        trendy = TrendyolScraper(name, session)
+        t_prices = trendy.get_data()
+
+    # prices_by_source dictionary: This dictionary stores prices from different sources (Google, Trendyol).
+    # Each key corresponds to a source, and the value is a list of prices from that source.
+    prices_by_source = {"google": g_prices, "trendyol": t_prices}
+
+    # Outliers (accessories, shipping fees, ...) are left out of the stats.
+    summary = robust_price_summary(prices_by_source)
+    if summary["dropped"]:
+        metrics.incr("price_outliers_dropped_total", summary["dropped"])
+
+    all_prices = summary["kept"] or [0.0]
+    avg_price = summary["avg_price"]
+
+    # Category detection
+    category = detect_category(desc)
+    analyzer = choose_analyzer(category, desc)
+
+    product = Product(
+        name=name,
+        category=category,
+        prices=all_prices,
+        avg_price=avg_price,
+        min_price=summary["min_price"],
+        max_price=summary["max_price"],
+        description=desc,
+    )
+
+    with metrics.timer("analyzer_seconds", analyzer=type(analyzer).__name__):
+        score = analyzer.calculate_value_score(product)
+        trend = analyzer.estimate_trend(product)
+
+    with metrics.timer("analyzer_seconds", analyzer="SupplyDemandAnalyzer"):
+        supply = SupplyDemandAnalyzer().analyze_supply_level(desc)
+    with metrics.timer("analyzer_seconds", analyzer="PriceConsistencyChecker"):
+        consistency = PriceConsistencyChecker().calculate_consistency(prices_by_source)
+
+    return {
+        "name": name,
+        "category": category,
+        "avg_price": avg_price,
+        "min_price": product.min_price,
+        "max_price": product.max_price,
+        "value_score": score,
+        "trend": trend,
+        "supply_level": supply,
+        "consistency": consistency,
+        "median_price": summary["median"],
+        "outliers_dropped": summary["dropped"],
+        "description": desc,
+        "prices_by_source": prices_by_source,
+    }
+
+
+def store_analysis(db: Database, user_id: int, result: dict, with_history=True):
+    """Saves an evaluate_product result for a user (and its prices)."""
+    product = Product(
+        name=result["name"],
+        category=result["category"],
+        prices=[p for lst in result["prices_by_source"].values() for p in lst],
+        avg_price=result["avg_price"],
+        min_price=result["min_price"],
+        max_price=result["max_price"],
+        description=result["description"],
+    )
+    db.add_product(
+        user_id, product, result["value_score"], result["trend"],
+        result["supply_level"], result["consistency"],
+    )
+    if with_history:
+        db.save_history(result["name"], result["prices_by_source"])
+
+
+def analyze_product(user_id: int, db: Database, name: str, sessions=None) -> dict:
+    """Scrapes, scores and stores one product; returns the summary."""
+    result = evaluate_product(name, sessions)
+    store_analysis(db, user_id, result)
+    return result
+
+
 # PRESENTATION HELPERS
 
 
+def print_analysis(result: dict):
+    """Prints the summary returned by analyze_product."""
+    print("\n--- ANALYSIS COMPLETE ---")
+    print(f"Name        : {result['name']}")
+    print(f"Category    : {result['category']}")
+    print(f"Avg Price   : {result['avg_price']:.2f} TL")
+    print(f"Min/Max     : {result['min_price']} / {result['max_price']}")
+    print(f"Score       : %{result['value_score']}")
+    print(f"Trend       : {result['trend']}")
+    print(f"Supply      : {result['supply_level']}")
+    print(f"Consistency : {result['consistency']}%")
+
+
 def show_price_chart(history):
     """Draws a simple price chart in the terminal."""
     if not history:
         print("No price history.")
         return
 
-    prices = [h.price for h in history]
-    maxi, mini = max(prices), min(prices)
+    maxi = max(h.max_price for h in history)
+    mini = min(h.min_price for h in history)
 
     print("\n--- PRICE CHART ---\n")
     for h in history:
         bar_len = int((h.price / maxi) * 40) if maxi else 0
         bar = "#" * bar_len
-        print(f"{h.date} [{h.source}] | {h.price:.2f} TL | {bar}")
+        # Rolled-up points show the bucket average and its tier.
+        tier = "" if h.tier == "raw" else f" {h.tier} avg of {h.count}"
+        print(f"{h.date} [{h.source}{tier}] | {h.price:.2f} TL | {bar}")
 
     print(f"\nMin: {mini:.2f} TL | Max: {maxi:.2f} TL\n")
 
@@ -691,56 +3041,8 @@ def handle_analyze_product(user_id, db):
         print("Name cannot be empty.")
         return True
 
-    # Scrapers
-    google = GoogleScraper(name)
-    g_prices, desc = google.get_data()
-
-    trendy = TrendyolScraper(name)
-    t_prices = trendy.get_data()
-
-    # prices_by_source dictionary: This dictionary stores prices from different sources (Google, Trendyol).
-    # Each key corresponds to a source, and the value is a list of prices from that source.
-    prices_by_source = {"google": g_prices, "trendyol": t_prices}
-
-    all_prices = [p for src in prices_by_source.values() for p in src if p > 0]
-    if not all_prices:
-        all_prices = [0.0]
-
-    avg_price = sum(all_prices) / len(all_prices)
-
-    # Category detection
-    category = detect_category(desc)
-    analyzer = choose_analyzer(category, desc)
-
-    product = Product(
-        name=name,
-        category=category,
-        prices=all_prices,
-        avg_price=avg_price,
-        min_price=min(all_prices),
-        max_price=max(all_prices),
-        description=desc,
-    )
-
-    score = analyzer.calculate_value_score(product)
-    trend = analyzer.estimate_trend(product)
-
-    supply = SupplyDemandAnalyzer().analyze_supply_level(desc)
-    consistency = PriceConsistencyChecker().calculate_consistency(prices_by_source)
-
-    # Save to DB
-    db.add_product(user_id, product, score, trend, supply, consistency)
-    db.save_history(name, prices_by_source)
-
-    print("\n--- ANALYSIS COMPLETE ---")
-    print(f"Name        : {name}")
-    print(f"Category    : {category}")
-    print(f"Avg Price   : {avg_price:.2f} TL")
-    print(f"Min/Max     : {product.min_price} / {product.max_price}")
-    print(f"Score       : %{score}")
-    print(f"Trend       : {trend}")
-    print(f"Supply      : {supply}")
-    print(f"Consistency : {consistency}%")
+    result = analyze_product(user_id, db, name)
+    print_analysis(result)
     return True
 
 def handle_price_history(db):
@@ -759,21 +3061,15 @@ def handle_price_history(db):
     return True
 
 
-def handle_compare_products(db):
+def handle_compare_products(user_id, db):
     n1 = input("First product: ").strip()
     n2 = input("Second product: ").strip()
 
-    with db.engine.connect() as conn:
-        rows = conn.execute(
-            select(
-                products_table.c.name,
-                products_table.c.avg_price,
-                products_table.c.value_score,
-                products_table.c.trend,
-                products_table.c.supply_level,
-                products_table.c.consistency,
-            ).where(products_table.c.name.in_([n1, n2]))
-        ).fetchall()
+    if n1 == n2:
+        print("Choose two different products.")
+        return True
+
+    rows = db.get_products_by_names(user_id, [n1, n2])
 
     if len(rows) < 2:
         print("Both products must exist.")
@@ -835,6 +3131,8 @@ def run_scrapy_spider():
     if not q:
         return True
 
+    import subprocess
+
     try:
         subprocess.run(
             ["scrapy", "crawl", "trendyol_spider", "-a", f"query={q}"],
@@ -849,9 +3147,812 @@ def exit_program():
     print("Exiting...")
     return False
     
+# HTTP API SERVER
+#
+# Small JSON API for dashboards and other services:
+#   python smartworth.py serve --port 8765
+#   curl -H "Authorization: Bearer $SMARTWORTH_TOKEN" localhost:8765/history?name=iphone
+#
+# All requests share one database pool, one scraper session pool and one
+# cache. Analyze requests for the same product that arrive while a scrape
+# is running wait for that scrape instead of starting another one.
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl: float = 300, max_entries: int = 10_000):
+        from collections import OrderedDict
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class HttpError(Exception):
+    """Raised by API handlers to answer with an HTTP error status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+MAX_BODY_BYTES = 1024 * 1024
+MAX_HEADERS = 100
+
+
+class ApiServer:
+    """asyncio HTTP/1.1 server exposing the analyzers as a JSON API."""
+
+    def __init__(self, host="127.0.0.1", port=8765, workers=8, cache_ttl=300,
+                 read_timeout=15.0, max_connections=256):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout  # idle keep-alive wait or one request read
+        self.max_connections = max_connections
+        self.connections = 0
+        self.db = Database()
+        self.auth = UserAuth()
+        self.sessions = ScraperSessionPool(workers)
+        self.cache = TTLCache(cache_ttl)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="smartworth-api")
+        self.inflight = {}  # product key -> asyncio.Task of the running scrape
+        self.routes = {
+            ("GET", "/health"): self.get_health,
+            ("GET", "/metrics"): self.get_metrics,
+            ("POST", "/analyze"): self.post_analyze,
+            ("GET", "/history"): self.get_history,
+            ("GET", "/compare"): self.get_compare,
+            ("GET", "/similar"): self.get_similar,
+            ("GET", "/products"): self.get_products,
+        }
+
+    async def blocking(self, fn, *args):
+        """Runs a blocking DB/scraper call on the worker threads."""
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # request plumbing
+
+    async def serve_forever(self):
+        import asyncio
+
+        # Open the database before the first client arrives.
+        await self.blocking(get_storage)
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        write_log("API server listening", host=self.host, port=self.port)
+        print(f"SMARTWORTH API listening on http://{self.host}:{self.port}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.sessions.close()
+
+    async def handle_client(self, reader, writer):
+        import asyncio
+
+        if self.connections >= self.max_connections:
+            metrics.incr("api_connections_rejected_total")
+            try:
+                await self.write_response(writer, 503, {"error": "too many connections"}, False)
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+
+        self.connections += 1
+        try:
+            while True:
+                # Idle clients and half-sent requests give up their slot.
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.read_timeout)
+                except asyncio.TimeoutError:
+                    metrics.incr("api_read_timeouts_total")
+                    break
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                status, payload = await self.dispatch(method, path, query, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except HttpError as e:
+            try:
+                await self.write_response(writer, e.status, {"error": e.message}, False)
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            # Never let one bad connection kill the handler task silently.
+            write_log("API connection error", "ERROR", error=repr(e))
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    async def read_line(reader) -> bytes:
+        """readline() that answers 400 when a line exceeds the stream limit."""
+        import asyncio
+
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HttpError(400, "request line or header too long")
+
+    async def read_request(self, reader):
+        from urllib.parse import urlsplit, parse_qs
+
+        line = await self.read_line(reader)
+        if not line:
+            return None
+        try:
+            method, target, _version = line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(400, "malformed request line")
+
+        headers = {}
+        while True:
+            line = await self.read_line(reader)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HttpError(400, "too many headers")
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        raw_length = headers.get("content-length", "").strip() or "0"
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            raise HttpError(400, "invalid Content-Length")
+        length = int(raw_length)
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b""
+
+        parts = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        return method.upper(), parts.path.rstrip("/") or "/", query, headers, body
+
+    async def write_response(self, writer, status: int, payload, keep_alive: bool):
+        # Handlers return JSON-able objects; plain strings go out as text.
+        if isinstance(payload, str):
+            data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+            content_type = "application/json"
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Error')}\r\n"
+            f"Content-Type: {content_type}; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def dispatch(self, method, path, query, headers, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            known = any(p == path for _m, p in self.routes)
+            status = 405 if known else 404
+            metrics.incr("api_responses_total", route="unknown", status=status)
+            return status, {"error": "no such endpoint"}
+
+        start = time.perf_counter()
+        try:
+            user_id = None
+            if path not in ("/health", "/metrics"):
+                user_id = await self.authenticate(headers)
+            status, payload = 200, await handler(user_id, query, body)
+        except HttpError as e:
+            status, payload = e.status, {"error": e.message}
+        except Exception as e:
+            write_log("API error", "ERROR", method=method, path=path, error=repr(e))
+            status, payload = 500, {"error": "internal error"}
+
+        metrics.observe("api_request_seconds", time.perf_counter() - start, route=path)
+        metrics.incr("api_responses_total", route=path, status=status)
+        return status, payload
+
+    async def authenticate(self, headers) -> int:
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            raise HttpError(401, "missing bearer token")
+
+        key = ("token", hashlib.sha256(token.encode()).hexdigest())
+        user_id = self.cache.get(key)
+        if user_id is None:
+            user_id, _role = await self.blocking(self.auth.login_with_token, token)
+            if user_id is None:
+                raise HttpError(401, "invalid token")
+            self.cache.set(key, user_id)
+        return user_id
+
+    @staticmethod
+    def require(query: dict, name: str) -> str:
+        value = query.get(name, "").strip()
+        if not value:
+            raise HttpError(400, f"missing parameter '{name}'")
+        return value
+
+    # endpoints
+
+    async def get_health(self, user_id, query, body):
+        return {"status": "ok", "inflight": len(self.inflight)}
+
+    async def get_metrics(self, user_id, query, body):
+        if query.get("format") == "json":
+            return metrics.snapshot()
+        return metrics.to_prometheus()
+
+    async def post_analyze(self, user_id, query, body):
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(400, "body must be JSON")
+        name = str(data.get("name", "") if isinstance(data, dict) else "").strip()
+        if not name:
+            raise HttpError(400, "missing 'name'")
+
+        result = await self.evaluate_shared(name)
+        # Every caller gets the product saved under their own account;
+        # the scraped prices are stored once by evaluate_shared.
+        await self.blocking(store_analysis, self.db, user_id, result, False)
+        return result
+
+    async def evaluate_shared(self, name: str) -> dict:
+        """
+        One scrape per product at a time; recent results come from cache.
+        Keyed by the exact name: history, compare and similar all match
+        names exactly, so a result must not be shared with (and saved
+        under) another spelling.
+        """
+        import asyncio
+
+        key = name
+        cached = self.cache.get(("analysis", key))
+        if cached is not None:
+            metrics.incr("api_analyze_total", outcome="cached")
+            return cached
+
+        task = self.inflight.get(key)
+        if task is not None:
+            metrics.incr("api_analyze_total", outcome="coalesced")
+        else:
+            metrics.incr("api_analyze_total", outcome="scraped")
+            task = asyncio.ensure_future(self.scrape_and_record(name))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _t: self.inflight.pop(key, None))
+
+        # shield: one client hanging up must not cancel the scrape for the rest.
+        return await asyncio.shield(task)
+
+    async def scrape_and_record(self, name: str) -> dict:
+        result = await self.blocking(evaluate_product, name, self.sessions)
+        await self.blocking(self.db.save_history, name, result["prices_by_source"])
+        self.cache.set(("analysis", name), result)
+        return result
+
+    async def get_history(self, user_id, query, body):
+        rows = await self.blocking(self.db.get_history, self.require(query, "name"))
+        return [row_to_dict(r) for r in rows]
+
+    async def get_compare(self, user_id, query, body):
+        names = [self.require(query, "a"), self.require(query, "b")]
+        if names[0] == names[1]:
+            raise HttpError(400, "choose two different products")
+        rows = await self.blocking(self.db.get_products_by_names, user_id, names)
+        if len(rows) < 2:
+            raise HttpError(404, "both products must exist")
+        return [row_to_dict(r) for r in rows]
+
+    async def get_similar(self, user_id, query, body):
+        name = self.require(query, "name")
+        try:
+            limit = int(query.get("limit", "5"))
+        except ValueError:
+            raise HttpError(400, "limit must be an integer")
+
+        results = await self.blocking(
+            SimilarityFinder().find_similar, self.db, user_id, name, limit
+        )
+        keys = ("similarity", "id", "name", "category", "avg_price", "value_score", "trend")
+        return [dict(zip(keys, r)) for r in results]
+
+    async def get_products(self, user_id, query, body):
+        rows = await self.blocking(self.db.get_products, user_id)
+        return [row_to_dict(r) for r in rows]
+
+
+# COMMAND LINE INTERFACE
+#
+# Non-interactive subcommands for cron jobs and pipelines, e.g.
+#   python smartworth.py token --username eda          (password from SMARTWORTH_PASSWORD)
+#   SMARTWORTH_TOKEN=... python smartworth.py list --format json
+#   python smartworth.py track "iphone 15" --interval 3600 --format ndjson
+# Exit codes do not depend on --format: 0 ok, 1 not found / invalid,
+# 2 authentication failed, 130 interrupted.
+
+
+def row_to_dict(row) -> dict:
+    """Turns a SQLAlchemy row (or a HistoryPoint) into a plain dict for JSON."""
+    if is_dataclass(row):
+        return asdict(row)
+    return dict(row._mapping)
+
+
+def emit_records(fmt: str, records, single: bool = False) -> None:
+    """
+    Writes records as one JSON document ("json") or one JSON object per
+    line ("ndjson"). NDJSON lines are flushed as soon as each record is
+    ready, so long-running commands like track can be piped.
+    """
+    if fmt == "ndjson":
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            sys.stdout.flush()
+        return
+
+    records = list(records)
+    doc = (records[0] if records else None) if single else records
+    print(json.dumps(doc, ensure_ascii=False, default=str, indent=2))
+
+
+def cli_error(message: str, code: int = 1) -> int:
+    print(f"error: {message}", file=sys.stderr)
+    return code
+
+
+def resolve_cli_user(args, auth: UserAuth):
+    """
+    Authenticates without prompts: --token, then SMARTWORTH_TOKEN, then
+    SMARTWORTH_USERNAME / SMARTWORTH_PASSWORD.
+    """
+    token = args.token or os.environ.get("SMARTWORTH_TOKEN", "")
+    if token:
+        return auth.login_with_token(token)
+
+    username = os.environ.get("SMARTWORTH_USERNAME", "")
+    password = os.environ.get("SMARTWORTH_PASSWORD", "")
+    return auth.check_credentials(username, password)
+
+
+def cli_credentials(args):
+    username = args.username or os.environ.get("SMARTWORTH_USERNAME", "")
+    password = args.password or os.environ.get("SMARTWORTH_PASSWORD", "")
+    return username, password
+
+
+def cmd_register(args, auth, db):
+    username, password = cli_credentials(args)
+    with contextlib.redirect_stdout(sys.stderr):
+        ok = auth.register(username, password)
+    if not ok:
+        return cli_error("registration failed")
+
+    if args.format == "text":
+        print(f"Registered {username}.")
+    else:
+        emit_records(args.format, [{"username": username}], single=True)
+    return 0
+
+
+def cmd_token(args, auth, db):
+    username, password = cli_credentials(args)
+    user_id, _role = auth.check_credentials(username, password)
+    if user_id is None:
+        return cli_error("incorrect username or password", 2)
+
+    token = auth.create_token(user_id)
+    if args.format == "text":
+        print(token)
+    else:
+        emit_records(args.format, [{"user_id": user_id, "token": token}], single=True)
+    return 0
+
+
+def cmd_analyze(args, user_id, db):
+    results = (analyze_product(user_id, db, name) for name in args.names)
+    if args.format == "text":
+        for result in results:
+            print_analysis(result)
+        return 0
+
+    emit_records(args.format, results, single=len(args.names) == 1)
+    return 0
+
+
+def cmd_history(args, user_id, db):
+    if args.summary:
+        summary = db.get_history_summary(args.name)
+        if not summary["count"]:
+            return cli_error("no history found")
+        if args.format == "text":
+            for key, value in summary.items():
+                print(f"{key:<8}: {value:.2f}" if isinstance(value, float) else f"{key:<8}: {value}")
+        else:
+            emit_records(args.format, [summary], single=True)
+        return 0
+
+    history = db.get_history(args.name)
+    # Same exit code for the same query in every format.
+    if not history:
+        return cli_error("no history found")
+
+    if args.format == "text":
+        for h in history:
+            print(f"{h.date} [{h.source}] -> {h.price} TL")
+        show_price_chart(history)
+        return 0
+
+    emit_records(args.format, (row_to_dict(h) for h in history))
+    return 0
+
+
+def cmd_compare(args, user_id, db):
+    if args.first == args.second:
+        return cli_error("choose two different products")
+    rows = db.get_products_by_names(user_id, [args.first, args.second])
+    if len(rows) < 2:
+        return cli_error("both products must exist")
+
+    if args.format == "text":
+        for r in rows:
+            print(f"{r.name} - Avg: {r.avg_price}, Score: %{r.value_score}, Trend: {r.trend}")
+        return 0
+
+    emit_records(args.format, (row_to_dict(r) for r in rows))
+    return 0
+
+
+def cmd_list(args, user_id, db):
+    if args.format == "text":
+        db.list_products(user_id)
+        return 0
+
+    emit_records(args.format, (row_to_dict(r) for r in db.get_products(user_id)))
+    return 0
+
+
+def cmd_card(args, user_id, db):
+    row = db.get_product_by_id(args.id)
+    if not row or row.user_id != user_id:
+        return cli_error("product not found")
+
+    if args.format == "text":
+        render_product_card(row)
+    else:
+        emit_records(args.format, [row_to_dict(row)], single=True)
+    return 0
+
+
+def cmd_similar(args, user_id, db):
+    results = SimilarityFinder().find_similar(db, user_id, args.name, limit=args.limit)
+    if args.format == "text":
+        if not results:
+            print("None found.")
+        for sim, pid, name, cat, avgp, score, tr in results:
+            print(f"[{pid}] {name} ({cat})  | Similarity: %{sim*100:.1f}")
+        return 0
+
+    keys = ("similarity", "id", "name", "category", "avg_price", "value_score", "trend")
+    emit_records(args.format, (dict(zip(keys, r)) for r in results))
+    return 0
+
+
+def cmd_delete(args, user_id, db):
+    row = db.get_product_by_id(args.id)
+    if not row or row.user_id != user_id:
+        return cli_error("product not found")
+
+    db.delete_product(args.id)
+    if args.format == "text":
+        print("Deleted.")
+    else:
+        emit_records(args.format, [{"deleted": args.id}], single=True)
+    return 0
+
+
+def cmd_track(args, user_id, db):
+    """Re-analyzes the given products every --interval seconds."""
+
+    def rounds():
+        done = 0
+        while True:
+            for name in args.names:
+                result = analyze_product(user_id, db, name)
+                result["checked_at"] = datetime.now().isoformat(timespec="seconds")
+                yield result
+            done += 1
+            if args.count and done >= args.count:
+                return
+            time.sleep(args.interval)
+
+    if args.format == "text":
+        for result in rounds():
+            print_analysis(result)
+        return 0
+
+    emit_records(args.format, rounds())
+    return 0
+
+
+def cmd_watch(args, user_id, db):
+    """watch add / list / delete for price alert rules."""
+    engine = get_alert_engine()
+
+    if args.action == "list":
+        rows = engine.list_rules(user_id)
+        if args.format != "text":
+            emit_records(args.format, (row_to_dict(r) for r in rows))
+            return 0
+        if not rows:
+            print("No alert rules.")
+        for r in rows:
+            state = "active" if r.active else f"fired {r.triggered_at}"
+            if r.kind == "below":
+                rule = f"price <= {r.threshold:.2f} TL"
+            elif r.kind == "drop":
+                rule = f"-{r.percent:g}% from {r.baseline:.2f} TL (<= {r.threshold:.2f} TL)"
+            else:
+                rule = "new all-time low"
+            print(f"[{r.id}] {r.product_name} | {rule} | {state}")
+        return 0
+
+    if args.action == "delete":
+        if not engine.delete_rule(user_id, args.id):
+            return cli_error("alert rule not found")
+        if args.format == "text":
+            print("Deleted.")
+        else:
+            emit_records(args.format, [{"deleted": args.id}], single=True)
+        return 0
+
+    if args.below is not None:
+        kind, kwargs = "below", {"threshold": args.below}
+    elif args.drop is not None:
+        kind, kwargs = "drop", {"percent": args.drop, "baseline": args.baseline}
+    else:
+        kind, kwargs = "new_low", {}
+
+    try:
+        rule = engine.add_rule(user_id, args.name, kind, **kwargs)
+    except ValueError as e:
+        return cli_error(str(e))
+
+    if args.format == "text":
+        print(f"Watching '{rule['product_name']}' ({kind}), rule id {rule['id']}.")
+    else:
+        emit_records(args.format, [rule], single=True)
+    return 0
+
+
+def cmd_compact(args, auth, db):
+    """Applies the history retention policy (safe to run from cron)."""
+    policy = RetentionPolicy(args.raw_days, args.hourly_days, args.daily_days)
+    compactor = HistoryCompactor(policy, args.chunk_size, args.max_chunks)
+    stats = compactor.run(full_vacuum=args.full_vacuum)
+
+    if args.format == "text":
+        print(
+            f"raw -> hourly: {stats['raw_to_hourly']} | "
+            f"hourly -> daily: {stats['hourly_to_daily']} | "
+            f"daily -> weekly: {stats['daily_to_weekly']} | "
+            f"chunks: {stats['chunks']} | vacuum: {stats['vacuum']}"
+        )
+    else:
+        emit_records(args.format, [stats], single=True)
+    return 0
+
+
+def cmd_serve(args, auth, db):
+    import asyncio
+
+    server = ApiServer(
+        args.host, args.port, args.workers, args.cache_ttl,
+        args.read_timeout, args.max_connections,
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--format", choices=["text", "json", "ndjson"], default="text",
+        help="output format (default: text)",
+    )
+    common.add_argument(
+        "--token", default="",
+        help="API token (default: $SMARTWORTH_TOKEN)",
+    )
+    common.add_argument(
+        "--profile", default="", metavar="FILE",
+        help="run under cProfile and save stats to FILE (default: $SMARTWORTH_PROFILE)",
+    )
+    common.add_argument(
+        "--metrics-out", default="", metavar="FILE",
+        help="write timings/counters on exit; .json or Prometheus text "
+             "(default: $SMARTWORTH_METRICS_OUT)",
+    )
+
+    credentials = argparse.ArgumentParser(add_help=False)
+    credentials.add_argument("--username", default="", help="default: $SMARTWORTH_USERNAME")
+    credentials.add_argument("--password", default="", help="default: $SMARTWORTH_PASSWORD")
+
+    parser = argparse.ArgumentParser(
+        prog="smartworth",
+        description="SMARTWORTH - Market Value Analyzer. Run without arguments for the menu.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("register", parents=[common, credentials], help="create an account")
+    p.set_defaults(handler=cmd_register, needs_user=False)
+
+    p = sub.add_parser("token", parents=[common, credentials], help="issue an API token")
+    p.set_defaults(handler=cmd_token, needs_user=False)
+
+    p = sub.add_parser("analyze", parents=[common], help="scrape, score and save products")
+    p.add_argument("names", nargs="+", metavar="NAME")
+    p.set_defaults(handler=cmd_analyze)
+
+    p = sub.add_parser("history", parents=[common], help="price history of a product")
+    p.add_argument("name")
+    p.add_argument("--summary", action="store_true", help="count / mean / percentiles only")
+    p.set_defaults(handler=cmd_history)
+
+    p = sub.add_parser("compare", parents=[common], help="compare two saved products")
+    p.add_argument("first")
+    p.add_argument("second")
+    p.set_defaults(handler=cmd_compare)
+
+    p = sub.add_parser("list", parents=[common], help="list saved products")
+    p.set_defaults(handler=cmd_list)
+
+    p = sub.add_parser("card", parents=[common], help="product detail card")
+    p.add_argument("id", type=int)
+    p.set_defaults(handler=cmd_card)
+
+    p = sub.add_parser("similar", parents=[common], help="find similar saved products")
+    p.add_argument("name")
+    p.add_argument("--limit", type=int, default=5)
+    p.set_defaults(handler=cmd_similar)
+
+    p = sub.add_parser("delete", parents=[common], help="delete a saved product")
+    p.add_argument("id", type=int)
+    p.set_defaults(handler=cmd_delete)
+
+    p = sub.add_parser("track", parents=[common], help="re-analyze products periodically")
+    p.add_argument("names", nargs="+", metavar="NAME")
+    p.add_argument("--interval", type=float, default=3600, help="seconds between rounds")
+    p.add_argument("--count", type=int, default=1, help="number of rounds, 0 = forever")
+    p.set_defaults(handler=cmd_track)
+
+    p = sub.add_parser("watch", help="price alerts (add / list / delete)")
+    watch = p.add_subparsers(dest="action", required=True)
+    w = watch.add_parser("add", parents=[common], help="watch a product")
+    w.add_argument("name")
+    rule = w.add_mutually_exclusive_group(required=True)
+    rule.add_argument("--below", type=float, metavar="PRICE", help="alert when price <= PRICE")
+    rule.add_argument("--drop", type=float, metavar="PCT", help="alert on a PCT %% drop")
+    rule.add_argument("--new-low", action="store_true", help="alert on every new all-time low")
+    w.add_argument("--baseline", type=float, help="reference price for --drop (default: latest price)")
+    w = watch.add_parser("list", parents=[common], help="list your alert rules")
+    w = watch.add_parser("delete", parents=[common], help="delete an alert rule")
+    w.add_argument("id", type=int)
+    p.set_defaults(handler=cmd_watch)
+
+    defaults = RetentionPolicy()
+    p = sub.add_parser("compact", parents=[common], help="roll up and prune old price history")
+    p.add_argument("--raw-days", type=int, default=defaults.raw_days)
+    p.add_argument("--hourly-days", type=int, default=defaults.hourly_days)
+    p.add_argument("--daily-days", type=int, default=defaults.daily_days)
+    p.add_argument("--chunk-size", type=int, default=2000, help="rows per transaction")
+    p.add_argument("--max-chunks", type=int, default=0, help="stop after N chunks (0 = all)")
+    p.add_argument(
+        "--full-vacuum", action="store_true",
+        help="rewrite the whole SQLite file afterwards (blocks writers while it runs)",
+    )
+    p.set_defaults(handler=cmd_compact, needs_user=False)
+
+    p = sub.add_parser("serve", parents=[common], help="run the local HTTP/JSON API")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=8, help="threads for DB and scraping")
+    p.add_argument("--cache-ttl", type=float, default=300, help="seconds to reuse an analysis")
+    p.add_argument(
+        "--read-timeout", type=float, default=15.0,
+        help="seconds a connection may sit idle or take to send a request",
+    )
+    p.add_argument("--max-connections", type=int, default=256, help="open connections at once")
+    p.set_defaults(handler=cmd_serve, needs_user=False)
+
+    return parser
+
+
+def run_instrumented(fn, profile_path="", metrics_path=""):
+    """Runs fn() with the optional profiler and metrics dump."""
+    profile_path = profile_path or os.environ.get("SMARTWORTH_PROFILE", "")
+    metrics_path = metrics_path or os.environ.get("SMARTWORTH_METRICS_OUT", "")
+    try:
+        with profiling(profile_path):
+            return fn()
+    finally:
+        if metrics_path:
+            metrics.dump(metrics_path)
+
+
+def run_cli(argv: list) -> int:
+    args = build_cli_parser().parse_args(argv)
+    return run_instrumented(
+        lambda: dispatch_cli(args), args.profile, args.metrics_out
+    )
+
+
+def dispatch_cli(args) -> int:
+    auth = UserAuth()
+    db = Database()
+
+    if not getattr(args, "needs_user", True):
+        return args.handler(args, auth, db)
+
+    user_id, _role = resolve_cli_user(args, auth)
+    if user_id is None:
+        return cli_error(
+            "authentication required (--token, SMARTWORTH_TOKEN or "
+            "SMARTWORTH_USERNAME/SMARTWORTH_PASSWORD)", 2
+        )
+
+    try:
+        return args.handler(args, user_id, db)
+    except KeyboardInterrupt:
+        return 130
+    except BrokenPipeError:
+        # Reader of our NDJSON stream went away (e.g. "| head").
+        return 0
+
+
 # MAIN LOOP
 
-def main():
+def run_interactive():
     auth = UserAuth()
     db = Database()
 
@@ -878,7 +3979,7 @@ def main():
     actions = {
         "1": lambda: handle_analyze_product(user_id, db),
         "2": lambda: handle_price_history(db),
-        "3": lambda: handle_compare_products(db),
+        "3": lambda: handle_compare_products(user_id, db),
         "4": lambda: handle_product_list(user_id, db),
         "5": lambda: handle_product_card(db),
         "6": lambda: handle_similarity_search(user_id, db),
@@ -895,5 +3996,13 @@ def main():
             break
 
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        run_instrumented(run_interactive)
+        return 0
+    return run_cli(argv)
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smartworth  # noqa: E402
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """A fresh SQLite database in a temp dir, used by every Database call."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SMARTWORTH_DB_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv("SMARTWORTH_LOG_FILE", str(tmp_path / "log.jsonl"))
+    monkeypatch.setattr(smartworth, "_storage", None)
+    monkeypatch.setattr(smartworth, "_alert_engine", None)
+
+    current = smartworth.get_storage()
+    yield current
+
+    if current.writer is not None:
+        current.writer.close()
+    current.engine.dispose()
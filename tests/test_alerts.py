@@ -0,0 +1,229 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import smartworth
+from smartworth import AlertEngine, ProductAlerts, WebhookAlertSink
+
+
+class ListSink:
+    def __init__(self, failures=0):
+        self.alerts = []
+        self.failures = failures  # the first N sends fail
+
+    def send(self, alert, done):
+        if self.failures:
+            self.failures -= 1
+            done(OSError("unreachable"))
+            return
+        self.alerts.append(alert)
+        done(None)
+
+
+@pytest.fixture
+def engine(storage, monkeypatch):
+    alerts = AlertEngine(sink=ListSink())
+    monkeypatch.setattr(smartworth, "_alert_engine", alerts)
+    return alerts
+
+
+def rule(rule_id, threshold, kind="below"):
+    return {"id": rule_id, "user_id": 1, "kind": kind, "threshold": threshold,
+            "percent": None, "baseline": None}
+
+
+def test_index_is_sorted_and_remove_finds_equal_thresholds():
+    entry = ProductAlerts([rule(1, 900.0), rule(2, 700.0), rule(3, 900.0),
+                           rule(4, None, "new_low"), rule(5, 800.0)])
+    assert entry.triggers == [700.0, 800.0, 900.0, 900.0]
+    assert set(entry.new_low_rules) == {4}
+
+    entry.add(rule(6, 850.0))
+    entry.remove(rule(3, 900.0))
+    entry.remove(rule(4, None, "new_low"))
+    assert entry.triggers == [700.0, 800.0, 850.0, 900.0]
+    assert [r["id"] for r in entry.trigger_rules] == [2, 5, 6, 1]
+    assert entry.new_low_rules == {}
+
+
+def test_below_rule_fires_once(engine):
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 1005.0]})
+    engine.add_rule(1, "phone", "below", threshold=950.0)
+
+    db.save_history("phone", {"trendyol": [940.0, 945.0, 942.0]})
+    db.save_history("phone", {"trendyol": [930.0, 935.0, 932.0]})
+
+    fired = [a for a in engine.sink.alerts if a["kind"] == "below"]
+    assert len(fired) == 1
+    assert fired[0]["price"] == 940.0
+    assert engine.list_rules(1)[0].active == 0
+
+
+def test_refresh_adds_rules_from_other_processes_without_reload(engine):
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 1005.0]})
+    loads = smartworth.metrics.counters.get(("alert_index_loads_total", ()), 0)
+
+    # Another process stores a rule; this engine only learns of it on refresh.
+    other = AlertEngine(sink=ListSink())
+    other.add_rule(2, "phone", "below", threshold=990.0)
+    engine.index_ttl = 0
+
+    db.save_history("phone", {"trendyol": [980.0, 985.0, 982.0]})
+    assert [a["user_id"] for a in engine.sink.alerts if a["kind"] == "below"] == [2]
+    assert smartworth.metrics.counters.get(("alert_index_loads_total", ()), 0) == loads
+
+
+def test_deleted_rules_do_not_fire(engine):
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 1005.0]})
+    mine = engine.add_rule(1, "phone", "below", threshold=950.0)
+    theirs = engine.add_rule(2, "phone", "below", threshold=960.0)
+
+    assert engine.delete_rule(1, mine["id"])
+    assert engine.products["phone"].triggers == [960.0]
+
+    # Deleted by another process: still indexed here, but must not fire.
+    assert AlertEngine(sink=ListSink()).delete_rule(2, theirs["id"])
+    db.save_history("phone", {"trendyol": [900.0, 905.0, 902.0]})
+    assert [a for a in engine.sink.alerts if a["kind"] == "below"] == []
+
+
+def stored_low_row(storage, name="phone"):
+    from sqlalchemy import select
+
+    with storage.engine.connect() as conn:
+        return conn.execute(
+            select(storage.lows.c.low).where(storage.lows.c.product_name == name)
+        ).first()
+
+
+def test_stored_low_ignores_outliers_after_restart(engine, storage, monkeypatch):
+    from sqlalchemy import delete
+
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0]})
+    engine.add_rule(1, "phone", "new_low")
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 50.0, 1005.0, 1002.0]})
+    assert stored_low_row(storage).low == 1000.0
+
+    # A fresh process with no stored low rebuilds it from the history.
+    with storage.engine.begin() as conn:
+        conn.execute(delete(storage.lows))
+    restarted = AlertEngine(sink=ListSink())
+    monkeypatch.setattr(smartworth, "_alert_engine", restarted)
+    restarted.prepare("phone")
+    assert stored_low_row(storage).low == 1000.0
+
+    db.save_history("phone", {"trendyol": [900.0, 905.0, 902.0]})
+    assert [(a["kind"], a["price"], a["previous_low"]) for a in restarted.sink.alerts] == [
+        ("new_low", 900.0, 1000.0)
+    ]
+
+
+def test_new_low_seen_across_processes(engine, storage, monkeypatch):
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 1005.0]})
+    engine.add_rule(1, "phone", "new_low")
+    engine.index_ttl = 0
+    other = AlertEngine(sink=ListSink(), index_ttl=0)
+
+    monkeypatch.setattr(smartworth, "_alert_engine", other)
+    db.save_history("phone", {"trendyol": [900.0, 905.0, 902.0]})
+    monkeypatch.setattr(smartworth, "_alert_engine", engine)
+    db.save_history("phone", {"trendyol": [950.0, 955.0, 952.0]})
+    db.save_history("phone", {"trendyol": [890.0, 895.0, 892.0]})
+
+    assert [(a["price"], a["previous_low"]) for a in other.sink.alerts] == [(900.0, 1000.0)]
+    assert [(a["price"], a["previous_low"]) for a in engine.sink.alerts] == [(890.0, 900.0)]
+
+    # Without new_low rules the low is no longer kept up to date.
+    assert engine.delete_rule(1, engine.list_rules(1)[0].id)
+    assert stored_low_row(storage) is None
+
+
+def test_stored_low_uses_clean_rollup_extremes(storage):
+    from sqlalchemy import insert
+
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0]})
+    bucket = {"product_name": "phone", "source": "trendyol", "bucket_start": "2024-01-01 00:00"}
+    with storage.engine.begin() as conn:
+        conn.execute(insert(storage.rollups["hourly"]), [
+            dict(bucket, min_price=40.0, avg_price=690.0, max_price=1030.0, count=3),
+            dict(bucket, min_price=980.0, avg_price=990.0, max_price=1000.0, count=3),
+        ])
+    assert AlertEngine.stored_low("phone") == 980.0
+
+
+def test_products_without_rules_never_read_history(engine, storage):
+    from sqlalchemy import event
+
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 1005.0]})
+    engine.add_rule(1, "phone", "below", threshold=950.0)
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(storage.engine, "before_cursor_execute", record)
+    try:
+        db.save_history("tablet", {"trendyol": [500.0, 510.0, 505.0]})
+        db.save_history("phone", {"trendyol": [990.0, 995.0, 992.0]})
+    finally:
+        event.remove(storage.engine, "before_cursor_execute", record)
+
+    reads = [st for st in statements if st.lstrip().upper().startswith("SELECT")]
+    assert reads and not any("history" in st for st in reads)
+    assert not any("price_lows" in st for st in statements)
+    assert engine.products["tablet"].empty
+
+
+def test_failed_delivery_keeps_one_shot_rule_active(engine):
+    engine.sink.failures = 1
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0, 1005.0]})
+    engine.add_rule(1, "phone", "below", threshold=950.0)
+
+    db.save_history("phone", {"trendyol": [940.0, 945.0, 942.0]})
+    assert engine.sink.alerts == []
+    assert engine.list_rules(1)[0].active == 1
+    assert engine.products["phone"].triggers == [950.0]
+
+    db.save_history("phone", {"trendyol": [930.0, 935.0, 932.0]})
+    assert [a["price"] for a in engine.sink.alerts] == [930.0]
+    assert engine.list_rules(1)[0].active == 0
+
+
+def test_webhook_close_delivers_queued_alerts():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            received.append(json.loads(self.rfile.read(length)))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sink = WebhookAlertSink(f"http://127.0.0.1:{server.server_port}/alerts")
+        results = []
+        for i in range(5):
+            sink.send({"rule_id": i}, results.append)
+        sink.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [a["rule_id"] for a in received] == [0, 1, 2, 3, 4]
+    assert results == [None] * 5
@@ -0,0 +1,186 @@
+import asyncio
+import json
+
+import pytest
+
+import smartworth
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def exchange(server, raw: bytes, limit: int = 2 ** 16):
+    """Feeds raw bytes to handle_client and returns (status, body)."""
+    async def run():
+        reader = asyncio.StreamReader(limit=limit)
+        reader.feed_data(raw)
+        reader.feed_eof()
+        writer = FakeWriter()
+        await server.handle_client(reader, writer)
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.closed
+    head, _, body = writer.data.partition(b"\r\n\r\n")
+    status = int(head.split()[1])
+    return status, json.loads(body) if body else None
+
+
+@pytest.fixture
+def server(storage):
+    api = smartworth.ApiServer(workers=2)
+    yield api
+    api.executor.shutdown(wait=True)
+
+
+@pytest.mark.parametrize("length", ["abc", "-5", "1e3", "²"])
+def test_bad_content_length_is_400(server, length):
+    raw = f"POST /analyze HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode("latin-1")
+    status, body = exchange(server, raw)
+    assert status == 400
+    assert body == {"error": "invalid Content-Length"}
+
+
+def test_oversized_header_line_is_400(server):
+    raw = b"GET /health HTTP/1.1\r\nX-Big: " + b"a" * 2048 + b"\r\n\r\n"
+    status, _ = exchange(server, raw, limit=1024)
+    assert status == 400
+
+
+def test_health_still_answers(server):
+    status, body = exchange(server, b"GET /health HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert status == 200
+    assert body["status"] == "ok"
+
+
+def save_product(db, user_id, name, avg):
+    product = smartworth.Product(name, "general", [avg], avg, avg, avg, "")
+    db.add_product(user_id, product, 50, "stable", "normal", 1.0)
+
+
+def test_compare_is_scoped_to_the_user_and_uses_latest_rows(server):
+    auth = smartworth.UserAuth()
+    assert auth.register("alice", "pw") and auth.register("bob", "pw")
+    alice, _ = auth.check_credentials("alice", "pw")
+    bob, _ = auth.check_credentials("bob", "pw")
+    token = auth.create_token(alice)
+
+    db = smartworth.Database()
+    save_product(db, alice, "phone", 1000.0)
+    save_product(db, alice, "phone", 1100.0)
+    save_product(db, bob, "tablet", 500.0)
+
+    def compare(a, b):
+        raw = (
+            f"GET /compare?a={a}&b={b} HTTP/1.1\r\n"
+            f"Authorization: Bearer {token}\r\nConnection: close\r\n\r\n"
+        )
+        return exchange(server, raw.encode())
+
+    # Duplicate rows of one product no longer pass as two products.
+    assert compare("phone", "phone")[0] == 400
+    # Another user's product is not visible.
+    assert compare("phone", "tablet")[0] == 404
+
+    save_product(db, alice, "tablet", 600.0)
+    status, body = compare("tablet", "phone")
+    assert status == 200
+    assert [(r["name"], r["avg_price"]) for r in body] == [("tablet", 600.0), ("phone", 1100.0)]
+
+
+def fake_evaluate(calls, delay=0.2):
+    import time
+
+    def evaluate(name, sessions=None):
+        calls.append(name)
+        time.sleep(delay)
+        prices = {"trendyol": [1000.0, 1010.0, 1005.0]}
+        return {
+            "name": name, "category": "general", "avg_price": 1005.0,
+            "min_price": 1000.0, "max_price": 1010.0, "value_score": 50,
+            "trend": "stable", "supply_level": "normal", "consistency": 1.0,
+            "median_price": 1005.0, "outliers_dropped": 0, "description": "",
+            "prices_by_source": prices,
+        }
+
+    return evaluate
+
+
+def test_each_spelling_is_analyzed_and_saved_under_its_own_name(server, monkeypatch):
+    calls = []
+    monkeypatch.setattr(smartworth, "evaluate_product", fake_evaluate(calls))
+    auth = smartworth.UserAuth()
+    assert auth.register("a", "pw") and auth.register("b", "pw")
+    a, _ = auth.check_credentials("a", "pw")
+    b, _ = auth.check_credentials("b", "pw")
+
+    async def run():
+        return await asyncio.gather(
+            server.post_analyze(a, {}, b'{"name": "iphone 15"}'),
+            server.post_analyze(b, {}, b'{"name": "iPhone 15"}'),
+        )
+
+    first, second = asyncio.run(run())
+    assert (first["name"], second["name"]) == ("iphone 15", "iPhone 15")
+    assert sorted(calls) == ["iPhone 15", "iphone 15"]
+
+    db = smartworth.Database()
+    assert [r.name for r in db.get_products(b)] == ["iPhone 15"]
+    assert len(db.get_history("iPhone 15")) == 3
+
+
+def test_idle_or_half_sent_requests_time_out(server):
+    import time
+
+    server.read_timeout = 0.1
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"GET /health HTTP/1.1\r\nHost: x\r\n")  # never finished
+        writer = FakeWriter()
+        await server.handle_client(reader, writer)
+        return writer
+
+    t = time.perf_counter()
+    writer = asyncio.run(run())
+    assert time.perf_counter() - t < 2
+    assert writer.closed and writer.data == b""
+    assert server.connections == 0
+
+
+def test_connections_over_the_limit_get_503(server):
+    server.max_connections = 1
+    server.connections = 1
+    status, body = exchange(server, b"GET /health HTTP/1.1\r\n\r\n")
+    assert status == 503
+    assert server.connections == 1
+
+
+def test_concurrent_analyses_share_one_scrape(server, monkeypatch):
+    calls = []
+    monkeypatch.setattr(smartworth, "evaluate_product", fake_evaluate(calls))
+
+    async def run():
+        return await asyncio.gather(*(server.evaluate_shared("phone") for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert calls == ["phone"]
+    assert all(r is results[0] for r in results)
+    # One history batch (three prices) for all ten callers.
+    assert len(smartworth.Database().get_history("phone")) == 3
+
+    # Later callers within the TTL are served from the cache.
+    asyncio.run(server.evaluate_shared("phone"))
+    assert calls == ["phone"]
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import smartworth
+from smartworth import run_cli
+
+
+@pytest.fixture
+def users(storage, monkeypatch):
+    for var in ("SMARTWORTH_TOKEN", "SMARTWORTH_USERNAME", "SMARTWORTH_PASSWORD"):
+        monkeypatch.delenv(var, raising=False)
+    auth = smartworth.UserAuth()
+    tokens = {}
+    for name in ("alice", "bob"):
+        assert auth.register(name, "pw")
+        user_id, _ = auth.check_credentials(name, "pw")
+        tokens[name] = (user_id, auth.create_token(user_id))
+    return tokens
+
+
+def run_json(capsys, *argv):
+    code = run_cli(list(argv) + ["--format", "json"])
+    return code, json.loads(capsys.readouterr().out or "null")
+
+
+def save_product(user_id, name="phone"):
+    product = smartworth.Product(name, "general", [100.0], 100.0, 90.0, 110.0, "")
+    smartworth.Database().add_product(user_id, product, 50, "stable", "normal", 1.0)
+    return smartworth.Database().get_products(user_id)[-1].id
+
+
+def test_token_command_issues_a_working_token(users, capsys, monkeypatch):
+    monkeypatch.setenv("SMARTWORTH_PASSWORD", "pw")
+    code, doc = run_json(capsys, "token", "--username", "alice")
+    assert code == 0
+    assert smartworth.UserAuth().login_with_token(doc["token"])[0] == users["alice"][0]
+
+    assert run_cli(["token", "--username", "alice", "--password", "wrong"]) == 2
+
+
+def test_auth_order_token_flag_then_env_token_then_password(users, capsys, monkeypatch):
+    alice, bob = users["alice"], users["bob"]
+    save_product(alice[0], "alice-phone")
+    save_product(bob[0], "bob-phone")
+
+    monkeypatch.setenv("SMARTWORTH_USERNAME", "alice")
+    monkeypatch.setenv("SMARTWORTH_PASSWORD", "pw")
+    assert [r["name"] for r in run_json(capsys, "list")[1]] == ["alice-phone"]
+
+    monkeypatch.setenv("SMARTWORTH_TOKEN", bob[1])
+    assert [r["name"] for r in run_json(capsys, "list")[1]] == ["bob-phone"]
+
+    code, doc = run_json(capsys, "list", "--token", alice[1])
+    assert [r["name"] for r in doc] == ["alice-phone"]
+
+    # An invalid token is not silently replaced by the password login.
+    assert run_cli(["list", "--token", "nope"]) == 2
+
+
+def test_missing_credentials_exit_2(users, capsys):
+    assert run_cli(["list", "--format", "json"]) == 2
+    assert capsys.readouterr().out == ""
+
+
+def test_ndjson_writes_one_object_per_line(users, capsys):
+    alice = users["alice"]
+    save_product(alice[0], "a")
+    save_product(alice[0], "b")
+
+    assert run_cli(["list", "--format", "ndjson", "--token", alice[1]]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["a", "b"]
+
+
+def test_card_and_delete_check_ownership(users, capsys):
+    alice, bob = users["alice"], users["bob"]
+    product_id = save_product(alice[0])
+
+    assert run_cli(["card", str(product_id), "--token", bob[1]]) == 1
+    assert run_cli(["delete", str(product_id), "--token", bob[1]]) == 1
+    assert smartworth.Database().get_product_by_id(product_id) is not None
+
+    code, doc = run_json(capsys, "card", str(product_id), "--token", alice[1])
+    assert code == 0 and doc["id"] == product_id
+    assert run_cli(["delete", str(product_id), "--token", alice[1]]) == 0
+    assert smartworth.Database().get_product_by_id(product_id) is None
+
+
+@pytest.mark.parametrize("fmt", ["text", "json", "ndjson"])
+def test_history_exit_codes_do_not_depend_on_format(users, capsys, fmt):
+    token = users["alice"][1]
+    assert run_cli(["history", "phone", "--format", fmt, "--token", token]) == 1
+
+    smartworth.Database().save_history("phone", {"trendyol": [100.0]})
+    assert run_cli(["history", "phone", "--format", fmt, "--token", token]) == 0
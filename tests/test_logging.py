@@ -0,0 +1,61 @@
+import json
+import math
+
+from smartworth import BackgroundLogger
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_fields_cannot_override_reserved_keys(tmp_path):
+    path = tmp_path / "log.jsonl"
+    logger = BackgroundLogger(path=str(path))
+    logger.log("INFO", "hello", ts="not a time", level="DEBUG", msg="other", user=3)
+    logger.close()
+
+    (record,) = read_lines(path)
+    assert record["level"] == "INFO"
+    assert record["msg"] == "hello"
+    assert record["fields"] == {"ts": "not a time", "level": "DEBUG", "msg": "other", "user": 3}
+
+
+def test_bad_record_does_not_kill_the_writer(tmp_path):
+    path = tmp_path / "log.jsonl"
+    logger = BackgroundLogger(path=str(path), flush_interval=0.05)
+    logger.log("INFO", "before")
+    logger.flush()
+
+    # A timestamp that cannot be formatted must only drop that record.
+    logger.records.put({"ts": math.nan, "level": "INFO", "msg": "broken"})
+    logger.log("INFO", "after")
+    logger.flush(timeout=2)
+    assert logger.thread.is_alive()
+    logger.close(timeout=2)
+
+    assert [r["msg"] for r in read_lines(path)] == ["before", "after"]
+
+
+def test_rotation_by_another_process_is_followed(tmp_path):
+    path = tmp_path / "shared.jsonl"
+    rotating = BackgroundLogger(path=str(path), max_bytes=200, backup_count=3)
+    other = BackgroundLogger(path=str(path), max_bytes=0, rotate_seconds=0)
+
+    other.log("INFO", "other-1")
+    other.flush()
+    rotating.log("INFO", "x" * 250)
+    rotating.flush()
+    rotating.log("INFO", "after-rotation")  # file is over 200 bytes: rotates first
+    rotating.flush()
+
+    other.log("INFO", "other-2")
+    other.flush()
+    rotating.close()
+    other.close()
+
+    live = [r["msg"] for r in read_lines(path)]
+    backup = [r["msg"] for r in read_lines(f"{path}.1")]
+    assert backup == ["other-1", "x" * 250]
+    assert live == ["after-rotation", "other-2"]
+    assert not (tmp_path / "shared.jsonl.2").exists()
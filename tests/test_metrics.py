@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from smartworth import Histogram, Metrics
+
+
+def strict_loads(text):
+    def reject(constant):
+        raise ValueError(f"non-standard JSON constant {constant}")
+
+    return json.loads(text, parse_constant=reject)
+
+
+def test_histogram_quantiles_use_bucket_bounds():
+    h = Histogram(buckets=(0.1, 1.0, 10.0))
+    for v in (0.05, 0.5, 0.5, 5.0):
+        h.observe(v)
+    assert h.quantile(0.25) == 0.1
+    assert h.quantile(0.5) == 1.0
+    assert h.quantile(1.0) == 10.0
+    assert h.counts == [1, 2, 1, 0]
+
+
+def test_slow_observations_keep_json_valid(tmp_path):
+    m = Metrics()
+    m.observe("evaluate_seconds", 20.0)
+
+    snap = m.snapshot()["histograms"][0]
+    assert snap["p99"] == 10.0
+    assert snap["max"] == 20.0
+    assert snap["buckets"]["+Inf"] == 1
+
+    path = tmp_path / "m.json"
+    m.dump(str(path))
+    assert strict_loads(path.read_text())["histograms"][0]["max"] == 20.0
+
+
+def test_timer_counts_errors_and_still_observes():
+    m = Metrics()
+    with pytest.raises(RuntimeError):
+        with m.timer("fetch_seconds", source="google"):
+            raise RuntimeError("down")
+
+    assert m.counters[("fetch_errors_total", (("source", "google"),))] == 1
+    assert m.histograms[("fetch_seconds", (("source", "google"),))].count == 1
+
+
+def test_prometheus_text_format(tmp_path):
+    m = Metrics()
+    m.incr("scrapes_total", source="google")
+    m.incr("scrapes_total", 2, source="trendyol")
+    m.observe("db_seconds", 0.003, method="get")
+    m.observe("db_seconds", 30.0, method="get")
+
+    text = m.to_prometheus()
+    lines = text.splitlines()
+    assert lines.count("# TYPE smartworth_scrapes_total counter") == 1
+    assert 'smartworth_scrapes_total{source="trendyol"} 2' in lines
+    assert "# TYPE smartworth_db_seconds histogram" in lines
+    assert 'smartworth_db_seconds_bucket{method="get",le="0.0025"} 0' in lines
+    assert 'smartworth_db_seconds_bucket{method="get",le="0.005"} 1' in lines
+    assert 'smartworth_db_seconds_bucket{method="get",le="+Inf"} 2' in lines
+    assert 'smartworth_db_seconds_count{method="get"} 2' in lines
+
+    path = tmp_path / "m.prom"
+    m.dump(str(path))
+    assert path.read_text() == text
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+import smartworth
+
+
+def test_profile_selection_and_fallback(monkeypatch, capsys):
+    monkeypatch.setenv("SMARTWORTH_STORAGE_PROFILE", " Simple ")
+    assert smartworth.load_storage_profile().name == "simple"
+
+    monkeypatch.setenv("SMARTWORTH_STORAGE_PROFILE", "bogus")
+    assert smartworth.load_storage_profile().name == smartworth.DEFAULT_STORAGE_PROFILE
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert "bogus" in err
+
+
+def test_concurrent_profile_pragmas_are_applied(storage):
+    profile = storage.profile
+    assert profile.name == "concurrent"
+    with storage.engine.connect() as conn:
+        pragma = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1  # NORMAL
+        assert pragma("busy_timeout") == profile.busy_timeout
+        assert pragma("cache_size") == profile.cache_size
+
+
+def test_writer_job_errors_reach_the_caller(storage):
+    def job(conn):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError, match="boom"):
+        storage.writer.run(job)
+    # The writer thread survives and keeps serving jobs.
+    assert storage.writer.run(lambda conn: 42) == 42
+
+
+def test_reads_continue_while_the_writer_holds_the_lock(storage):
+    from sqlalchemy import func, insert, select
+
+    history = storage.history
+    started, release = threading.Event(), threading.Event()
+
+    def long_job(conn):
+        conn.execute(insert(history), [
+            {"product_name": "phone", "price": 1.0, "source": "t", "date": "x"}
+        ])
+        started.set()
+        release.wait(5)
+
+    future = storage.writer.submit(long_job)
+    assert started.wait(5)
+    try:
+        t = time.perf_counter()
+        with storage.engine.connect() as conn:
+            count = conn.execute(select(func.count()).select_from(history)).scalar()
+        elapsed = time.perf_counter() - t
+    finally:
+        release.set()
+    future.result(5)
+
+    assert count == 0  # the uncommitted batch is not visible yet
+    assert elapsed < 1.0  # and the reader did not wait for the writer
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import smartworth
+from smartworth import HistoryCompactor, RetentionPolicy
+
+
+def seed(storage, days_ago, prices, now):
+    from sqlalchemy import insert
+
+    date = (now - timedelta(days=days_ago)).strftime(smartworth.RAW_DATE_FORMAT)
+    rows = [
+        {"product_name": "phone", "price": p, "source": "trendyol", "date": date}
+        for p in prices
+    ]
+    with storage.engine.begin() as conn:
+        conn.execute(insert(storage.history), rows)
+
+
+def test_compaction_preserves_aggregates(storage):
+    now = datetime(2024, 6, 1, 12, 0)
+    seed(storage, 40, [100.0, 110.0, 120.0, 0.0], now)
+    seed(storage, 200, [90.0, 95.0], now)
+    seed(storage, 1, [130.0], now)
+
+    stats = HistoryCompactor(RetentionPolicy(), chunk_size=2).run(now=now)
+    assert stats["raw_to_hourly"] == 6  # the failed 0.0 scrape is dropped too
+    assert stats["hourly_to_daily"] == 1
+
+    points = smartworth.Database().get_history("phone")
+    assert [p.tier for p in points] == ["daily", "hourly", "raw"]
+    daily, hourly, raw = points
+    assert (daily.min_price, daily.max_price, daily.count, daily.price) == (90.0, 95.0, 2, 92.5)
+    assert (hourly.min_price, hourly.max_price, hourly.count, hourly.price) == (100.0, 120.0, 3, 110.0)
+    assert raw.price == 130.0
+
+
+def test_chunk_budget_resets_between_runs(storage):
+    now = datetime(2024, 6, 1, 12, 0)
+    seed(storage, 40, [100.0] * 6, now)
+
+    compactor = HistoryCompactor(chunk_size=2, max_chunks=2)
+    assert compactor.run(now=now)["raw_to_hourly"] == 4
+    second = compactor.run(now=now)
+    assert second["raw_to_hourly"] == 2
+    assert second["chunks"] == 1
+
+
+def test_chunks_reclaim_pages_incrementally(storage):
+    now = datetime(2024, 6, 1, 12, 0)
+    seed(storage, 40, [float(i) for i in range(1, 5001)], now)
+
+    with storage.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+        pages_before = conn.exec_driver_sql("PRAGMA page_count").scalar()
+
+    stats = HistoryCompactor(chunk_size=1000).run(now=now)
+    assert stats["vacuum"] == "incremental"
+
+    with storage.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA freelist_count").scalar() == 0
+        assert conn.exec_driver_sql("PRAGMA page_count").scalar() < pages_before
@@ -0,0 +1,94 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import smartworth
+from smartworth import StreamingSummary, TDigest, filter_outliers, quantile
+
+
+def test_filter_outliers_mad():
+    assert filter_outliers([1000.0, 1010.0, 50.0, 1005.0, 1002.0]) == [1000.0, 1010.0, 1005.0, 1002.0]
+
+
+def test_filter_outliers_iqr_fallback_when_mad_is_zero():
+    values = [100.0] * 6 + [101.0, 99.0, 5000.0]
+    assert filter_outliers(values) == [100.0] * 6 + [101.0, 99.0]
+
+
+def test_filter_outliers_leaves_short_lists_alone():
+    assert filter_outliers([5.0, 5000.0]) == [5.0, 5000.0]
+
+
+@pytest.mark.parametrize("order", ["random", "sorted", "reversed"])
+def test_tdigest_does_not_depend_on_input_order(order):
+    rng = random.Random(7)
+    values = [rng.uniform(0, 1000) for _ in range(20_000)]
+    exact = sorted(values)
+    if order == "sorted":
+        values = exact
+    elif order == "reversed":
+        values = exact[::-1]
+
+    digest = TDigest()
+    for v in values:
+        digest.add(v)
+    for q in (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99):
+        assert digest.quantile(q) == pytest.approx(quantile(exact, q), abs=5.0)
+
+
+def test_summary_weights_buckets_by_count():
+    raw = StreamingSummary()
+    for v in [90.0, 95.0, 100.0, 110.0, 120.0, 130.0]:
+        raw.add(v)
+
+    rolled = StreamingSummary()
+    rolled.add_bucket(92.5, 90.0, 95.0, 2)
+    rolled.add_bucket(110.0, 100.0, 120.0, 3)
+    rolled.add(130.0)
+
+    a, b = raw.as_dict(), rolled.as_dict()
+    assert b["count"] == a["count"] == 6
+    assert b["mean"] == pytest.approx(a["mean"])
+    assert (b["min"], b["max"]) == (a["min"], a["max"]) == (90.0, 130.0)
+
+
+def test_summary_keeps_outliers_out_of_mean_min_max():
+    summary = StreamingSummary()
+    for v in [1000.0, 1010.0, 50.0, 1005.0, 1002.0] * 20:
+        summary.add(v)
+
+    result = summary.as_dict()
+    assert result["count"] == 100
+    assert result["min"] == 1000.0
+    assert result["max"] == 1010.0
+    assert result["mean"] == pytest.approx(1004.25, abs=1.0)
+    assert result["outliers"] >= 20
+
+
+def test_history_summary_survives_compaction(storage):
+    from sqlalchemy import insert
+
+    now = datetime(2024, 6, 1, 12, 0)
+    rng = random.Random(3)
+    rows = [
+        {
+            "product_name": "phone",
+            "price": round(rng.uniform(900, 1100), 2),
+            "source": "trendyol",
+            "date": (now - timedelta(days=60, hours=i // 5)).strftime(smartworth.RAW_DATE_FORMAT),
+        }
+        for i in range(500, 0, -1)
+    ]
+    with storage.engine.begin() as conn:
+        conn.execute(insert(storage.history), rows)
+
+    db = smartworth.Database()
+    before = db.get_history_summary("phone")
+    smartworth.HistoryCompactor().run(now=now)
+    after = db.get_history_summary("phone")
+
+    assert after["count"] == before["count"] == 500
+    assert after["mean"] == pytest.approx(before["mean"])
+    assert (after["min"], after["max"]) == (before["min"], before["max"])
+    assert after["p50"] == pytest.approx(before["p50"], abs=20)
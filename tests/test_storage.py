@@ -0,0 +1,159 @@
+import smartworth
+from smartworth import copy_history_rows, copy_text_value, create_history_partitions
+
+
+class FakeCopy:
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write_row(self, row):
+        self.log.append(("row", row))
+
+
+class FakeCursor:
+    """Stands in for a psycopg 3 / psycopg2 cursor and records the COPY."""
+
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy(self, sql):
+        self.log.append(("sql", sql))
+        return FakeCopy(self.log)
+
+    def copy_expert(self, sql, buf):
+        self.log.append(("sql", sql))
+        self.log.append(("data", buf.read()))
+
+
+class FakeConnection:
+    def __init__(self, driver):
+        self.log = []
+        self.dialect = type("Dialect", (), {"name": "postgresql", "driver": driver})()
+        cursor = FakeCursor(self.log)
+        raw = type("Raw", (), {"cursor": lambda _self: cursor})()
+        self.connection = type("Pooled", (), {"driver_connection": raw})()
+        self.statements = []
+
+    def execute(self, stmt):
+        self.statements.append(str(stmt))
+
+
+ROWS = [
+    {"product_name": "phone", "price": 1000.0, "source": "trendyol", "date": "01-01-2024 10:00"},
+    {"product_name": "tab\there", "price": None, "source": "google", "date": "01-01-2024 10:00"},
+]
+
+
+def test_copy_text_value_escapes_special_characters():
+    assert copy_text_value(None) == "\\N"
+    assert copy_text_value(12.5) == "12.5"
+    assert copy_text_value("a\\b\tc\nd\re") == "a\\\\b\\tc\\nd\\re"
+
+
+def test_copy_history_rows_psycopg3_writes_rows():
+    conn = FakeConnection("psycopg")
+    copy_history_rows(conn, ROWS)
+
+    assert conn.log[0] == (
+        "sql", "COPY history (product_name, price, source, date) FROM STDIN"
+    )
+    assert conn.log[1:] == [
+        ("row", ("phone", 1000.0, "trendyol", "01-01-2024 10:00")),
+        ("row", ("tab\there", None, "google", "01-01-2024 10:00")),
+    ]
+
+
+def test_copy_history_rows_psycopg2_streams_text_format():
+    conn = FakeConnection("psycopg2")
+    copy_history_rows(conn, ROWS)
+
+    data = conn.log[1][1]
+    assert data.splitlines() == [
+        "phone\t1000.0\ttrendyol\t01-01-2024 10:00",
+        "tab\\there\t\\N\tgoogle\t01-01-2024 10:00",
+    ]
+
+
+def test_bulk_insert_history_uses_copy_on_postgresql():
+    conn = FakeConnection("psycopg")
+    smartworth.bulk_insert_history(conn, ROWS[:1])
+    assert [kind for kind, _ in conn.log] == ["sql", "row"]
+
+
+def test_create_history_partitions_ddl():
+    conn = FakeConnection("psycopg")
+    create_history_partitions(conn, 4)
+
+    parent, *children, index = conn.statements
+    assert "PARTITION BY HASH (product_name)" in parent
+    assert "PRIMARY KEY (id, product_name)" in parent
+    assert children == [
+        f"CREATE TABLE IF NOT EXISTS history_p{i} PARTITION OF history "
+        f"FOR VALUES WITH (MODULUS 4, REMAINDER {i})"
+        for i in range(4)
+    ]
+    assert index.startswith("CREATE INDEX IF NOT EXISTS history_product_name_idx")
+
+
+def test_save_history_round_trip_on_sqlite(storage):
+    db = smartworth.Database()
+    db.save_history("phone", {"trendyol": [1000.0, 1010.0], "google": [990.0]})
+
+    points = db.get_history("phone")
+    assert sorted(p.price for p in points) == [990.0, 1000.0, 1010.0]
+    assert {p.tier for p in points} == {"raw"}
+
+
+def test_migration_rebuilds_old_products_key(tmp_path, monkeypatch):
+    import sqlite3
+
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as raw:
+        raw.execute(
+            "CREATE TABLE products (id INTEGER, user_id INTEGER, name VARCHAR,"
+            " category VARCHAR, avg_price FLOAT, min_price FLOAT, max_price FLOAT,"
+            " price_spread FLOAT, value_score INTEGER, trend VARCHAR, description TEXT,"
+            " supply_level VARCHAR, consistency FLOAT, date_added VARCHAR,"
+            " PRIMARY KEY (id, user_id))"
+        )
+        raw.execute("INSERT INTO products (id, user_id, name) VALUES (7, 1, 'phone')")
+
+    monkeypatch.setenv("SMARTWORTH_DB_URL", f"sqlite:///{path}")
+    monkeypatch.setattr(smartworth, "_storage", None)
+    current = smartworth.get_storage()
+    try:
+        with current.engine.connect() as conn:
+            pk = [r[1] for r in conn.exec_driver_sql("PRAGMA table_info(products)") if r[5]]
+            version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+            indexes = {r[1] for r in conn.exec_driver_sql("PRAGMA index_list(history)")}
+        assert pk == ["id"]
+        assert version == smartworth.SQLITE_SCHEMA_VERSION
+        assert "ix_history_product_name" in indexes
+        assert smartworth.Database().get_product_by_id(7).name == "phone"
+    finally:
+        if current.writer is not None:
+            current.writer.close()
+        current.engine.dispose()
+
+    # Once user_version is set, opening the file skips the migration.
+    def fail(_storage):
+        raise AssertionError("migration ran again")
+
+    monkeypatch.setattr(smartworth, "migrate_sqlite_schema", fail)
+    monkeypatch.setattr(smartworth, "_storage", None)
+    again = smartworth.get_storage()
+    if again.writer is not None:
+        again.writer.close()
+    again.engine.dispose()